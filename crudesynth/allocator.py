@@ -0,0 +1,136 @@
+"""Voice slot allocation for the VoiceBank.
+
+The pool is the first `limit` slots of the bank (the Voices knob). Free
+slots sit on a stack, so a note-on with room left is a pop. When the pool
+is full a voice is stolen according to `policy`; after the limit was
+lowered, voices are stolen until the new one fits and the extra ones end:
+
+    'oldest'    the voice that started first
+    'quietest'  the voice with the lowest envelope level
+    'released'  the oldest released voice, else the oldest
+
+With `retrigger` on, a note that is still sounding reuses its own voice.
+"""
+import collections
+
+import numpy as np
+
+from settings import MAX_VOICES
+
+POLICIES = ('oldest', 'quietest', 'released')
+
+class VoiceAllocator:
+    def __init__(self, bank, limit=MAX_VOICES, policy='oldest', retrigger=True):
+        self.bank = bank
+        self.policy = policy
+        self.retrigger = retrigger
+
+        self._free = [] # stack of free slots
+        self._playing = collections.OrderedDict() # slot -> note, in note-on order
+        self._released = collections.OrderedDict() # slot -> note, in release order
+        self._slot_of = {} # note -> slot of its latest voice
+        self.limit = limit
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @limit.setter
+    def limit(self, n):
+        """Resize the pool; voices above it play out but are not reused"""
+        self._limit = max(1, min(int(n), self.bank.n_slots))
+        busy = set(self._playing) | set(self._released)
+        self._free = [s for s in range(self._limit-1, -1, -1) if s not in busy]
+
+    @property
+    def n_active(self):
+        return len(self._playing) + len(self._released)
+
+    # -------
+    def reclaim(self):
+        """Return the slots the bank finished since the last call to the pool"""
+        freed = self.bank.freed
+        while freed:
+            slot = freed.pop()
+            note = self._playing.pop(slot, None)
+            if note is None:
+                note = self._released.pop(slot, None)
+            if note is None:
+                continue # already stolen
+            if self._slot_of.get(note) == slot:
+                del self._slot_of[note]
+            if slot < self._limit:
+                self._free.append(slot)
+        return
+
+    def _forget(self, slot):
+        note = self._playing.pop(slot, None)
+        if note is None:
+            note = self._released.pop(slot)
+        if self._slot_of.get(note) == slot:
+            del self._slot_of[note]
+        return
+
+    def _steal(self):
+        policy = self.policy
+        if policy == 'released' and self._released:
+            return next(iter(self._released))
+
+        if policy == 'quietest':
+            slots = np.fromiter(self._playing, int, len(self._playing))
+            slots = np.concatenate([slots, np.fromiter(self._released, int, len(self._released))])
+            return int(slots[np.argmin(self.bank.levels(slots))])
+
+        if self._playing:
+            return next(iter(self._playing))
+        return next(iter(self._released))
+
+    def _make_room(self, stolen):
+        """Steal until a new voice fits the pool and return its slot.
+        The other stolen voices end, those in the pool go back on the free
+        stack; stolen holds slots already taken off the books."""
+        stolen = list(stolen)
+        for slot in stolen:
+            if slot < self._limit:
+                self._free.append(slot)
+
+        while self.n_active >= self._limit:
+            slot = self._steal()
+            self._forget(slot)
+            stolen.append(slot)
+            if slot < self._limit:
+                self._free.append(slot)
+
+        slot = self._free.pop()
+        for s in stolen:
+            if s != slot:
+                self.bank.stop(s) # over the limit, or back on the free stack
+        return slot
+
+    def note_on(self, note):
+        """Slot for a new voice of note; the caller starts it"""
+        self.reclaim()
+
+        slot = self._slot_of.get(note)
+        if self.retrigger and slot is not None:
+            self._forget(slot)
+            if slot >= self._limit or self.n_active >= self._limit:
+                # the limit was lowered: give up this slot like a stolen one
+                slot = self._make_room([slot])
+        elif self.n_active < self._limit:
+            slot = self._free.pop()
+        else:
+            slot = self._make_room([])
+
+        self._playing[slot] = note
+        self._slot_of[note] = slot
+        return slot
+
+    def note_off(self, note):
+        """Slots to release for note, those not stolen or ended already"""
+        self.reclaim()
+
+        slots = [slot for slot, n in self._playing.items() if n == note]
+        for slot in slots:
+            self._released[slot] = self._playing.pop(slot)
+        return slots
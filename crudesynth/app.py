@@ -1,25 +1,17 @@
+import math
 import sys
-import math as math
-import uuid
+import time
 
-import numpy as np
 import sounddevice as sd
 
 import pygame
 
 import gui
-from core import OSC, LFO, ControlOscillator, Voice 
-
-from dsp import (
-    sine_wave,
-    sawtooth_wave,
-    trianlge_wave,
-    pulse_wave,
-    noise,
-    ADSEnvelope,
-    release_envelope,
-    RBJFilter
-)
+from core import OSC, LFO, gen_funcs, freqs
+from engine import AudioEngine, EngineProcess, RenderAhead
+from perf import FramePacer, Profiler, format_stats
+from settings import MIN_FPS, AUTOMATION_FPS, AUDIO_MODE, RENDER_AHEAD, ENGINE_CPU, PERF_LOG_INTERVAL, TRACE_PATH
+from widgets import LoadMeter, update_dirty
 
 WIDTH = 1280
 HEIGHT = 720
@@ -36,91 +28,30 @@ def check_piano_click(mouse_rect, event, rects):
     else:
         return None
 
-def build_voice(osc1, lfo1, osc2, lfo2, note, freqs, adsr, gen_funcs, mod_funcs):
-    kwargs = {'frequency': freqs[note+osc1.detune]} 
-    gen1 = gen_funcs[osc1.menu.menu_text]
-    
-    if lfo1.on == True:
-        mod_gen = mod_funcs[lfo1.lfo_func] # get lfo func
-
-        if lfo1.lfo_func == 'pulse':
-            # set duty and use depth to modulate frequency
-            kwargs['modulator'] = mod_gen(lfo1.rate, duty_cycle=lfo1.duty)
-            kwargs['depth'] = lfo1.depth
-        else:
-            # NO special settigns
-            kwargs['modulator'] = mod_gen(lfo1.rate)
-            kwargs['depth'] = lfo1.depth # used in main osc generator with modulator (is freq)
-    else:
-        kwargs['modulator'] = None
-        kwargs['depth'] = None
-
-    if osc1.menu.menu_text == 'pulse': # applies to OSC
-        kwargs['duty_cycle'] = osc1.pw_knob.value
-
-    if osc2.toggle.active:
-        kwargs2 = {'frequency': freqs[note+osc2.detune]}
-        gen2 = gen_funcs[osc2.menu.menu_text]
-        # Build modulator if on
-        if lfo2.on == True:
-            mod_gen = mod_funcs[lfo2.lfo_func] # get lfo func
-
-            if lfo2.lfo_func == 'pulse':
-                # set duty and use depth to modulate frequency
-                kwargs2['modulator'] = mod_gen(lfo2.rate, duty_cycle=lfo2.duty)
-                kwargs2['depth'] = lfo2.depth
-            else:
-                # NO special settigns
-                kwargs2['modulator'] = mod_gen(lfo2.rate)
-                kwargs2['depth'] = lfo2.depth # used in main osc generator with modulator (is freq)
-        else:
-            kwargs2['modulator'] = None
-            kwargs2['depth'] = None
-
-        if osc2.menu.menu_text == 'pulse': # applies to OSC
-            kwargs2['duty_cycle'] = osc2.pw_knob.value
-
-        osc2_gen = gen2(**kwargs2)
-    else:
-        osc2_gen=None
-
-    voice = Voice(
-        generator = gen1(**kwargs),
-        osc2 = osc2_gen,
-        envelope = ADSEnvelope(
-            attack_time = adsr['Attack'],
-            decay_time = adsr['Decay'],
-            sustain = adsr['Sustain'],
-            sample_rate = SAMPLE_RATE
-        ),
-        g1 = osc1.gain,
-        g2 = osc2.gain
-    )
-
-    return voice
-
-def add_voice(voice, retrigger, note, voices_to_release, voices):
-    voice_id = None
-    if retrigger.active and note in voices_to_release.keys():
-        # note previously generated a voice
-        voice_id = voices_to_release[note]
-
-    # check if voice is still active/exists, override is so
-    if voice_id in voices.keys():
-        voices.pop(voice_id)
-        voices[voice_id] = voice
-
-    else:
-        # Voice no longer active or never existed, generate one
-        voice_id = uuid.uuid4()
-        voices[voice_id] = voice
-        voices_to_release[note] = voice_id
-
-    # check number of voices | remove oldest / steal voice
-    if len(voices) > n_voices['val']: #never passed...
-        voices = dict(list(voices.items())[-n_voices['val']:])
-
-    return voices
+def build_layer(osc, lfo):
+    """Snapshot of an oscillator and its LFO for a note-on"""
+    return {
+        'wave': osc.menu.menu_text,
+        'detune': osc.detune,
+        'gain': osc.gain,
+        'duty': osc.pw_knob.value, # only used by pulse
+        'lfo': {
+            'wave': lfo.lfo_func,
+            'rate': lfo.rate,
+            'depth': lfo.depth, # in Hz, added to the osc frequency
+            'duty': lfo.duty,
+            'pwm': lfo.pw_mod if lfo.pwm_on else 0.0 # pulse width depth
+        } if lfo.on else None
+    }
+
+def build_patch(osc1, lfo1, osc2, lfo2, adsr):
+    return {
+        'osc': [
+            build_layer(osc1, lfo1),
+            build_layer(osc2, lfo2) if osc2.toggle.active else None
+        ],
+        'adsr': dict(adsr)
+    }
 
 
 # -----------------------
@@ -132,21 +63,6 @@ screen = pygame.display.set_mode((WIDTH, HEIGHT))
 pygame.display.set_caption('Crude Synth')
 clock = pygame.time.Clock()
 
-gen_funcs = {
-    'sine': sine_wave,
-    'sawtooth': sawtooth_wave,
-    'triangle': trianlge_wave,
-    'noise': noise,
-    'pulse': pulse_wave
-}
-
-mod_funcs = {
-    'sine': sine_wave,
-    'sawtooth': sawtooth_wave,
-    'triangle': trianlge_wave,
-    'pulse': pulse_wave,
-}
-
 adsr = {
     'Attack': 0.5,
     'Decay': 0.5,
@@ -155,16 +71,36 @@ adsr = {
     'gain': 0.5
 }
 
+# Audio engine, only reached through Remotes from here on
+if AUDIO_MODE == 'process':
+    engine = EngineProcess(freqs, gen_funcs, RENDER_AHEAD, ENGINE_CPU)
+else:
+    engine = AudioEngine(freqs, gen_funcs)
+if TRACE_PATH:
+    engine.trace(TRACE_PATH)
+synth = engine.remote()
+voice_filter = engine.remote('voice_filter')
+filter_lfo = engine.remote('filter_lfo', local=('control', 'rect'))
+
 # Stream SoundDevice
 devices = sd.query_hostapis()
 device = devices[0]['default_output_device']
 
+render_ahead = None
+callback = None
+if AUDIO_MODE == 'ring':
+    render_ahead = RenderAhead(engine, RENDER_AHEAD)
+    callback = render_ahead.callback
+elif AUDIO_MODE in ('callback', 'process'):
+    callback = engine.callback
+
 stream = sd.OutputStream(
     samplerate = int(SAMPLE_RATE),
-    blocksize = 0,
+    blocksize = BUFFER_SIZE if callback else 0,
     device = device,
     channels = 1,
-    dtype = 'float32'
+    dtype = 'float32',
+    callback = callback
 )
 
 # ------------------
@@ -211,17 +147,19 @@ results = gui.make_lfo_panel(lfo_rect2, lfo2, controls, labels, value_boxes, fon
 controls, labels, value_boxes, lfo2 = results
 # ============
 # ----- Filter
-voice_filter = RBJFilter(250)
-filter_lfo = ControlOscillator()
 filter_rect = pygame.Rect(WIDTH*0.82, HEIGHT*0.10, 200, 150)
 
 results = gui.make_filter_box(filter_rect, filter_lfo, voice_filter, controls, labels, value_boxes, font)
 controls, labels, value_boxes, filter_lfo, voice_filter, filter_toggle = results
+filter_toggle.add_subscriber(obj=synth, attr='filter_on')
 
 # =================
 # --- Voice Control
-results = gui.make_voice_controls(controls, labels, value_boxes, font)
-controls, labels, value_boxes, retrigger, n_voices = results
+allocator = engine.remote('allocator')
+results = gui.make_voice_controls(controls, labels, value_boxes, font, allocator)
+controls, labels, value_boxes = results
+
+controls, labels = gui.make_oversample_menu(WIDTH*0.35, HEIGHT*0.55, synth, controls, labels, font)
 
 # ---------- Piano Keys
 wkeys, bkeys, piano_keys = gui.make_piano_keys()
@@ -254,31 +192,42 @@ for value_box in value_boxes:
 for k in piano_keys:
     k.draw()
 
-was_under = False
-load_led = pygame.Rect((10,HEIGHT*0.72,8,8))
-pygame.draw.circle(screen, (0,0,0), (load_led.x, load_led.y), 6, 1)
+load_meter = LoadMeter(10, HEIGHT*0.72, font2)
+load_meter.draw()
+pygame.display.update() # whole window once, then only what widgets redraw
+gui_prof = Profiler(1/FPS, ('events', 'audio', 'draw')) # audio: render + write in blocking mode
+# in blocking mode every pass writes one block, so the loop may not run
+# slower than the block rate
+pacer = FramePacer(FPS, max(MIN_FPS, math.ceil(SAMPLE_RATE / BUFFER_SIZE)) if AUDIO_MODE == 'blocking' else MIN_FPS)
+next_meter = 0
+next_log = time.monotonic() + PERF_LOG_INTERVAL
 
 # ----------------
 #      MAIN
 # ----------------
 KEYLIST = ['a','w','s','e','d','f','t','g','y','h','u','j']
 octave = 2
-freqs = [round(440.0 * math.pow(2, (i-49)/12), 4) for i in range(4,89)]
 
 mouse_held = None 
 active_control = None
 
-voices_to_release = {}
-voices = {}
-
-base_gain = 0.4
+synth.gain = adsr['gain']
+shown_cutoff = None
 
+if render_ahead:
+    render_ahead.start()
+elif AUDIO_MODE == 'process':
+    engine.start()
 stream.start()
 while True:
+    frame_start = gui_prof.begin()
     for event in pygame.event.get():
         if event.type == pygame.QUIT:
             stream.stop()
             stream.close()
+            if render_ahead:
+                render_ahead.stop()
+            engine.close()
             pygame.quit()
             sys.exit()
 
@@ -311,18 +260,14 @@ while True:
                     mouse_held = piano_keys[button_clicked._id-12]
                     note = button_clicked._id #-12
 
-                    voice = build_voice(osc1, lfo1, osc2, lfo2, note, freqs, adsr, gen_funcs, mod_funcs)
-                    voices = add_voice(voice, retrigger, note, voices_to_release, voices)
+                    patch = build_patch(osc1, lfo1, osc2, lfo2, adsr)
+                    synth.note_on(note, patch)
                     button_clicked.draw()
 
         elif event.type == pygame.MOUSEBUTTONUP and event.button == 1:
             if mouse_held:
                 mouse_held.active = False
-                voice_id = voices_to_release[mouse_held._id]
-
-                # Check that voice is still active (i.e.not stolen) and release it
-                if voice_id in voices.keys():
-                    voices[voice_id].release(adsr)
+                synth.note_off(mouse_held._id, adsr['Release'])
 
                 mouse_held.draw()
                 mouse_held = None
@@ -351,8 +296,8 @@ while True:
                     button.active = True
                     button.kb_has_control = True
                     
-                    voice = build_voice(osc1, lfo1, osc2, lfo2, note, freqs, adsr, gen_funcs, mod_funcs)
-                    voices = add_voice(voice,retrigger, note, voices_to_release, voices)
+                    patch = build_patch(osc1, lfo1, osc2, lfo2, adsr)
+                    synth.note_on(note, patch)
                     button.draw()
 
             elif event.key == pygame.K_DOWN:
@@ -376,55 +321,45 @@ while True:
                     button.active = False
                     button.kb_has_control = False
 
-                    voice_id = voices_to_release[note]
-                    # Check that voice is still active (i.e. not stolen) and release it
-                    if voice_id in voices.keys():
-                        voices[voice_id].release(adsr)
+                    synth.note_off(note, adsr['Release'])
 
                     button.draw()
 
+    t = gui_prof.lap('events', frame_start)
+
     # ---------
     # -- Update
-    if voices:
-        if filter_lfo.on and filter_lfo._gen:
-            filter_lfo.update_control()
-
-        temp_voices = {}
-        samples = np.zeros(BUFFER_SIZE)
-        for key, voice in voices.items():
-            data = voice.get_audio_data(BUFFER_SIZE)
-
-            if voice._release == False:
-                samples += data
-                temp_voices[key] = voice
-
-            elif voice._release == True:
-                if data.sum() != 0:
-                    samples += data
-                    temp_voices[key] = voice
-
-        voices = temp_voices
-
-        if filter_toggle.active:
-            samples = voice_filter.process(samples)
-
-        samples = np.float32(samples*base_gain*adsr['gain'])
-        underflow = stream.write(samples)
-    else:
-        samples = np.float32(np.zeros(BUFFER_SIZE))
-        underflow = stream.write(samples)
-
-    if was_under:
-        pygame.draw.circle(screen, (255,255,255), (load_led.x, load_led.y), 5)
-        was_under = False
-
-    if underflow:
-        was_under = True
-        pygame.draw.circle(screen, (255,0,0), (load_led.x, load_led.y), 5)
-
-
-    pygame.display.update()
-    clock.tick(FPS)
+    if adsr['gain'] != synth.gain:
+        synth.gain = adsr['gain']
+
+    # Move the cutoff knob along with the filter LFO, redrawn at AUTOMATION_FPS
+    now = time.monotonic()
+    if filter_lfo.on and engine.cutoff is not None and engine.cutoff != shown_cutoff:
+        shown_cutoff = engine.cutoff
+        filter_lfo.control.automated_update(shown_cutoff)
+    filter_lfo.control.refresh_automation(now, 1/AUTOMATION_FPS)
+
+    if AUDIO_MODE == 'blocking':
+        t = gui_prof.lap('draw', t) # knobs drawn above
+        engine.underflows += stream.write(engine.render(BUFFER_SIZE))
+        t = gui_prof.lap('audio', t)
+
+    # Load meter and frame rate a few times a second, log line every PERF_LOG_INTERVAL
+    now = time.monotonic()
+    if now >= next_meter:
+        next_meter = now + 0.25
+        stats = engine.stats()
+        pacer.update(stats, now)
+        load_meter.update(stats, gui_prof.stats()['stages']['draw'], pacer.fps)
+
+        if PERF_LOG_INTERVAL and now >= next_log:
+            next_log = now + PERF_LOG_INTERVAL
+            print(format_stats(stats, stats['underflows']), flush=True)
+
+    update_dirty() # nothing to push on idle frames
+    gui_prof.lap('draw', t)
+    gui_prof.end(frame_start)
+    clock.tick(pacer.fps)
 
 
 # eof
@@ -0,0 +1,379 @@
+"""Benchmarks for the DSP hot paths.
+
+Every case renders BUFFER_SIZE blocks and reports the per-block time as a
+fraction of the block deadline (BUFFER_SIZE / SAMPLE_RATE). Output is JSON
+so runs can be compared across versions.
+
+    python bench.py [--voices 1,8,16,64] [--waves sine,pulse] [--threads 1,4] [--oversample 1,2,4] [--blocks 20] [--text]
+"""
+import argparse
+import itertools
+import json
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from core import ControlOscillator, gen_funcs, freqs
+from dsp import (
+    sine_wave, sawtooth_wave, trianlge_wave, pulse_wave, noise, RBJFilter, Decimator, PulseOscillator,
+    IDLE, ATTACK, DECAY, SUSTAIN, RELEASE
+)
+from engine import AudioEngine
+from settings import BUFFER_SIZE, SAMPLE_RATE, OVERSAMPLE_FACTORS, SILENCE_LEVEL
+
+BUDGET = BUFFER_SIZE / SAMPLE_RATE
+
+generators = {
+    'sine': sine_wave,
+    'sawtooth': sawtooth_wave,
+    'triangle': trianlge_wave,
+    'pulse': pulse_wave,
+    'noise': noise
+}
+
+# -----------------------------
+# Reference voice: one object per note with its own oscillators and
+# envelope. The app renders all voices together in core.VoiceBank; this is
+# kept to benchmark and check the bank against.
+class Envelope:
+    """ADSR envelope kept as arrays instead of a per-sample generator.
+
+    Attack/decay (and later release) are np.linspace segments; render(frames)
+    returns the next frames as a view of a segment when the block fits in
+    one, otherwise the pieces are copied into a scratch buffer with the
+    sustain (or silence) level filled in after the last segment. The result
+    is only valid until the next call and must not be modified.
+    """
+    def __init__(self, attack_time, decay_time, sustain=0.5, sample_rate=SAMPLE_RATE):
+        # max frames is 44100 == 1 sec
+        self.sustain = max(min(1.0, sustain), 0)
+        self.sample_rate = sample_rate
+
+        attack_frames = int(sample_rate * attack_time)
+        decay_frames = int(sample_rate * decay_time)
+        self._set_segments(
+            [(ATTACK, np.linspace(0.0, 1.0, attack_frames)),
+             (DECAY, np.linspace(1.0, self.sustain, decay_frames))],
+            SUSTAIN, self.sustain
+        )
+        self._out = np.empty(0)
+
+    def release(self, release_time):
+        """Ramp from the current value to 0 over release_time seconds"""
+        release_frames = int(self.sample_rate * release_time)
+        segment = np.linspace(self.value, 0.0, release_frames)
+        self._set_segments([(RELEASE, segment)], IDLE, 0.0)
+        return
+
+    def _set_segments(self, segments, hold_stage, hold):
+        self._segments = segments
+        self._hold_stage = hold_stage
+        self._hold = hold
+        self._enter(0)
+
+    def _enter(self, index):
+        """Start segment index, skipping empty ones"""
+        segments = self._segments
+        while index < len(segments) and not len(segments[index][1]):
+            index += 1
+        self._index = index
+        self.position = 0 # frames into the current stage
+        self.stage = segments[index][0] if index < len(segments) else self._hold_stage
+
+    @property
+    def value(self):
+        """Next sample the envelope will output"""
+        if self._index < len(self._segments):
+            return float(self._segments[self._index][1][self.position])
+        return self._hold
+
+    @property
+    def done(self):
+        return self.stage == IDLE
+
+    def render(self, frames):
+        segments = self._segments
+        if self._index < len(segments):
+            seg = segments[self._index][1]
+            end = self.position + frames
+            if end <= len(seg):
+                # whole block inside one segment
+                out = seg[self.position:end]
+                self.position = end
+                if end == len(seg):
+                    self._enter(self._index + 1)
+                return out
+
+        out = self._buffer(frames)
+
+        filled = 0
+        while filled < frames and self._index < len(segments):
+            seg = segments[self._index][1]
+            n = min(frames - filled, len(seg) - self.position)
+            out[filled:filled+n] = seg[self.position:self.position+n]
+            filled += n
+            self.position += n
+            if self.position == len(seg):
+                self._enter(self._index + 1)
+
+        out[filled:] = self._hold
+        self.position += frames - filled
+        return out
+
+    def _buffer(self, frames):
+        if len(self._out) < frames:
+            self._out = np.empty(frames)
+        return self._out[:frames]
+
+class Voice:
+    def __init__(self, generator, osc2=None, envelope=None, g1=1, g2=1, sample_rate=SAMPLE_RATE):
+        self._osc1 = generator
+        self._osc2 = osc2
+        self._envelope = envelope
+        self.sample_rate = sample_rate
+        self._release = False
+        self._gain1 = 0.1 * g1
+        self._gain2 = 0.1 * g2
+        
+    def release(self, adsr):
+        self._envelope.release(adsr["Release"])
+        self._release = True
+        return
+
+    @property
+    def finished(self):
+        """Release has run out or faded below SILENCE_LEVEL"""
+        env = self._envelope
+        return env.done or (self._release and env.value < SILENCE_LEVEL)
+
+    def get_audio_data(self, frames):
+        if self.finished:
+            return np.zeros(frames)
+
+        samples = self._osc1.render(frames) * self._gain1
+
+        if self._osc2:
+            samples += self._osc2.render(frames) * self._gain2
+                
+        samples *= self._envelope.render(frames)
+        
+        return samples 
+   
+
+def build_voice(note, patch, freqs, gen_funcs, seed=None):
+    """Single Voice object for a note, from the same patch the VoiceBank uses.
+    seed is for noise oscillators."""
+    oscs = []
+    for osc in patch['osc']:
+        if osc is None:
+            oscs.append((None, 0))
+            continue
+
+        kwargs = {'frequency': freqs[note+osc['detune']]}
+        lfo = osc['lfo']
+        if lfo:
+            lfo_kwargs = {'duty_cycle': lfo['duty']} if lfo['wave'] == 'pulse' else {}
+            kwargs['modulator'] = gen_funcs[lfo['wave']](lfo['rate'], **lfo_kwargs)
+            kwargs['depth'] = lfo['depth']
+
+        if issubclass(gen_funcs[osc['wave']], PulseOscillator):
+            kwargs['duty_cycle'] = osc['duty']
+            if lfo and lfo.get('pwm'):
+                # second copy of the LFO, in phase with the first
+                kwargs['d_mod'] = gen_funcs[lfo['wave']](lfo['rate'], **lfo_kwargs)
+                kwargs['depth_D'] = lfo['pwm']
+        elif osc['wave'] == 'noise':
+            kwargs['seed'] = seed
+
+        oscs.append((gen_funcs[osc['wave']](**kwargs), osc['gain']))
+
+    adsr = patch['adsr']
+    return Voice(
+        generator = oscs[0][0],
+        osc2 = oscs[1][0],
+        envelope = Envelope(
+            attack_time = adsr['Attack'],
+            decay_time = adsr['Decay'],
+            sustain = adsr['Sustain'],
+            sample_rate = SAMPLE_RATE
+        ),
+        g1 = oscs[0][1],
+        g2 = oscs[1][1]
+    )
+
+
+# -----------------------------
+def time_blocks(render, blocks):
+    """Seconds taken by each of `blocks` calls, after one warm up call"""
+    render()
+    times = []
+    for _ in range(blocks):
+        start = time.perf_counter()
+        render()
+        times.append(time.perf_counter() - start)
+    return times
+
+def result(name, times, **params):
+    median = statistics.median(times)
+    return dict(
+        name=name,
+        **params,
+        median_s=median,
+        worst_s=max(times),
+        load=median / BUDGET, # fraction of the block deadline
+        worst_load=max(times) / BUDGET
+    )
+
+def make_patch(wave, lfo=False, osc2=False):
+    layer = {
+        'wave': wave,
+        'detune': 0,
+        'gain': 0.5,
+        'duty': 0.3,
+        'lfo': {'wave': 'sine', 'rate': 5, 'depth': 20, 'duty': 0.5} if lfo else None
+    }
+    return {
+        'osc': [layer, dict(layer, detune=7) if osc2 else None],
+        'adsr': {'Attack': 0.01, 'Decay': 0.1, 'Sustain': 0.5, 'Release': 0.5}
+    }
+
+# -----------------------------
+def bench_generators(waves, blocks):
+    results = []
+    for wave in waves:
+        if wave not in generators:
+            continue # block only waveform
+        gen = generators[wave](440.0)
+        render = lambda: [next(gen) for _ in range(BUFFER_SIZE)]
+        results.append(result('generator', time_blocks(render, blocks), wave=wave))
+    return results
+
+def bench_oscillators(waves, blocks):
+    results = []
+    for wave in waves:
+        for lfo in (False, True):
+            osc = gen_funcs[wave](440.0, gen_funcs['sine'](5) if lfo else None, 20)
+            render = lambda: osc.render(BUFFER_SIZE)
+            results.append(result('block_oscillator', time_blocks(render, blocks), wave=wave, lfo=lfo))
+    return results
+
+def bench_voice(waves, blocks):
+    results = []
+    for wave in waves:
+        for lfo in (False, True):
+            voice = build_voice(45, make_patch(wave, lfo, osc2=True), freqs, gen_funcs)
+            render = lambda: voice.get_audio_data(BUFFER_SIZE)
+            results.append(result('voice', time_blocks(render, blocks), wave=wave, lfo=lfo))
+    return results
+
+def bench_filter(blocks):
+    samples = np.random.uniform(-1, 1, BUFFER_SIZE)
+    cutoff = 400 + 200 * np.sin(np.linspace(0, np.pi, BUFFER_SIZE))
+    filt = RBJFilter(400)
+    return [
+        result('filter', time_blocks(lambda: filt.process(samples.copy()), blocks), kernel='block'),
+        result('filter', time_blocks(lambda: filt.process_direct(samples.copy()), blocks), kernel='direct'),
+        result('filter', time_blocks(lambda: filt.process_cutoff(samples.copy(), cutoff), blocks), kernel='modulated'),
+    ]
+
+def bench_control(blocks):
+    results = []
+    for wave in ControlOscillator.mod_funcs:
+        control = ControlOscillator()
+        control.lfo_func = wave
+        control.rate = 2
+        control.depth = 200
+        control.center_freq = 400
+        render = lambda: control.render(BUFFER_SIZE)
+        results.append(result('control_oscillator', time_blocks(render, blocks), wave=wave))
+    return results
+
+def bench_decimator(blocks):
+    results = []
+    for factor in OVERSAMPLE_FACTORS[1:]:
+        decimator = Decimator(factor)
+        samples = np.random.uniform(-1, 1, BUFFER_SIZE * factor)
+        render = lambda: decimator.process(samples)
+        results.append(result('decimator', time_blocks(render, blocks), factor=factor))
+    return results
+
+def bench_mix(voice_counts, waves, blocks, threads=(1,), oversample=(1,)):
+    """Full engine block: voices, mix, filter LFO and filter"""
+    results = []
+    for n_threads, factor, n_voices, wave, lfo, filter_on in itertools.product(
+        threads, oversample, voice_counts, waves, (False, True), (False, True)
+    ):
+        engine = AudioEngine(freqs, gen_funcs, threads=n_threads)
+        engine.oversample = factor
+        engine.filter_on = filter_on
+        engine.filter_lfo.on = filter_on and lfo
+        engine.filter_lfo.rate = 2
+        engine.filter_lfo.depth = 200
+        engine.filter_lfo.center_freq = 400
+        engine.allocator.limit = n_voices
+
+        patch = make_patch(wave, lfo, osc2=True)
+        for i in range(n_voices):
+            engine.note_on(10 + i, patch)
+
+        render = lambda: engine.render(BUFFER_SIZE)
+        results.append(result(
+            'mix', time_blocks(render, blocks),
+            voices=n_voices, wave=wave, lfo=lfo, filter=filter_on, threads=n_threads, oversample=factor
+        ))
+        engine.close()
+    return results
+
+# -----------------------------
+def main():
+    parser = argparse.ArgumentParser(description='Time the DSP hot paths against the block deadline')
+    parser.add_argument('--voices', default='1,8,16,64', help='comma separated voice counts for the mix')
+    parser.add_argument('--waves', default=','.join(gen_funcs), help='comma separated waveforms')
+    parser.add_argument('--threads', default='1', help='comma separated voice render thread counts for the mix')
+    parser.add_argument('--oversample', default='1', help='comma separated oversampling factors for the mix')
+    parser.add_argument('--blocks', type=int, default=20, help='timed blocks per case')
+    parser.add_argument('--text', action='store_true', help='print a table instead of JSON')
+    args = parser.parse_args()
+
+    voice_counts = [int(n) for n in args.voices.split(',')]
+    waves = args.waves.split(',')
+    threads = [int(n) for n in args.threads.split(',')]
+    oversample = [int(n) for n in args.oversample.split(',')]
+
+    results = (
+        bench_generators(waves, args.blocks)
+        + bench_oscillators(waves, args.blocks)
+        + bench_voice(waves, args.blocks)
+        + bench_filter(args.blocks)
+        + bench_control(args.blocks)
+        + bench_decimator(args.blocks)
+        + bench_mix(voice_counts, waves, args.blocks, threads, oversample)
+    )
+
+    if args.text:
+        for r in results:
+            params = ' '.join(f'{k}={v}' for k, v in r.items()
+                              if k not in ('name', 'median_s', 'worst_s', 'load', 'worst_load'))
+            print(f"{r['name']:<20} {params:<70} {r['median_s']*1e3:8.3f} ms {r['load']:7.1%}")
+        return
+
+    json.dump({
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'block_size': BUFFER_SIZE,
+            'sample_rate': SAMPLE_RATE,
+            'budget_s': BUDGET
+        },
+        'results': results
+    }, sys.stdout, indent=1)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,47 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 from dsp import (
-    sine_wave,
-    sawtooth_wave,
-    trianlge_wave,
-    pulse_wave,
-    noise,
-    ADSEnvelope,
-    release_envelope
+    SineOscillator,
+    SawtoothOscillator,
+    TriangleOscillator,
+    PulseOscillator,
+    NoiseOscillator,
+    BlepSawOscillator,
+    BlepPulseOscillator,
+    pwm_duty,
+    WavetableSawOscillator,
+    WavetableSquareOscillator,
+    WavetableTriangleOscillator,
+    IDLE,
+    ATTACK,
+    DECAY,
+    SUSTAIN,
+    RELEASE
 )
+from settings import NOTE_AMP, SILENCE_LEVEL, RENDER_THREADS, OVERSAMPLE_FACTORS
 
 SAMPLE_RATE = 44100
 BUFFER_SIZE = 256*4
+
+# Oscillator menu entries -> block oscillators
+gen_funcs = {
+    'sine': SineOscillator,
+    'sawtooth': SawtoothOscillator,
+    'triangle': TriangleOscillator,
+    'noise': NoiseOscillator,
+    'pulse': PulseOscillator,
+    'blep saw': BlepSawOscillator,
+    'blep pulse': BlepPulseOscillator,
+    'wt saw': WavetableSawOscillator,
+    'wt square': WavetableSquareOscillator,
+    'wt triangle': WavetableTriangleOscillator
+}
+
+# Note number -> frequency, 45 is A4 (440 Hz)
+freqs = [round(440.0 * math.pow(2, (i-49)/12), 4) for i in range(4,89)]
 # -----------------------------
 class OSC:
     def __init__(self):
@@ -30,15 +60,15 @@ class LFO:
         self.lfo_func = 'sine'
         self.duty = 0.5
         self.pwm_on = False
-        self.pw_mod = 0.25
+        self.pw_mod = 0.25 # fixed PWM depth, the PWM toggle only switches it on
         self.pulse_depth_on = False
         
 class ControlOscillator:
     mod_funcs = {
-    'sine': sine_wave,
-    'sawtooth': sawtooth_wave,
-    'triangle': trianlge_wave,
-    'pulse': pulse_wave
+    'sine': SineOscillator,
+    'sawtooth': SawtoothOscillator,
+    'triangle': TriangleOscillator,
+    'pulse': PulseOscillator
     }
 
     def __init__(self): #, control, depth, rate, center_value):
@@ -47,6 +77,7 @@ class ControlOscillator:
         self.depth = None #depth
         self.lfo_func = 'sine'
         self.center_freq = None #center_value
+        self.limits = (0.0, SAMPLE_RATE/2) # clamp range of the control value
         self._gen = None
         self.control = None #control
 
@@ -73,47 +104,322 @@ class ControlOscillator:
         self._gen = self.mod_funcs[self.lfo_func](self.rate)
         return
 
-    def update_control(self):
-        mod_ = [next(self._gen) for _ in range(BUFFER_SIZE)][-1]
-        new_value = self.center_freq + self.depth * mod_
-        self.control.automated_update(new_value)
-        return
+    def render(self, frames=BUFFER_SIZE):
+        """Control value for every sample of a block, clamped to limits.
+
+        The filter follows these within the block; the GUI control is moved
+        separately, from the GUI thread.
+        """
+        mod_ = self._gen.render(frames)
+        return np.clip(self.center_freq + self.depth * mod_, *self.limits)
       
-class Voice:
-    def __init__(self, generator, osc2=None, envelope=None, g1=1, g2=1, sample_rate=SAMPLE_RATE):
-        self._osc1 = generator
-        self._osc2 = osc2
-        self._envelope = envelope
+# ----------------------------------
+MIN_THREAD_VOICES = 4 # fewer voices per thread cost more in handoff than they save
+
+class VoiceBank:
+    """Structure-of-arrays store for all voices.
+
+    Every voice lives in a slot. The state of its two oscillator layers,
+    their LFOs and its envelope is kept in preallocated arrays indexed by
+    slot, and all active slots are rendered together as one
+    (voices x frames) block that is summed with a single reduction.
+
+    With threads > 1 the active voices are split into chunks rendered on a
+    thread pool, each into its own rows of the block and its own partial
+    mix; threads=1 renders everything on the calling thread.
+    """
+    def __init__(self, n_slots, freqs, gen_funcs, frames=BUFFER_SIZE, sample_rate=SAMPLE_RATE,
+                 silence=SILENCE_LEVEL, threads=RENDER_THREADS, seed=None):
+        self.n_slots = n_slots
+        self.freqs = freqs
         self.sample_rate = sample_rate
-        self._release = False
-        self._gain1 = 0.1 * g1
-        self._gain2 = 0.1 * g2
-        
-    def release(self, adsr):
-        release = adsr["Release"]
-        self._envelope = release_envelope(
-            release_time = release,
-            start_amp = next(self._envelope),
-            sample_rate = self.sample_rate
+        self.silence = silence # released voices quieter than this are freed
+        self.frames = frames
+
+        # waveform name <-> code, shapes indexed by code
+        self.wave_codes = {name: code for code, name in enumerate(gen_funcs)}
+        self.shapes = [gen_funcs[name].shape for name in gen_funcs]
+        self.noise_codes = {code for code, name in enumerate(gen_funcs)
+                            if issubclass(gen_funcs[name], NoiseOscillator)}
+
+        layers = (n_slots, 2)
+        # -- Oscillators
+        self.osc_on = np.zeros(layers, dtype=bool)
+        self.wave = np.zeros(layers, dtype=int)
+        self.phase = np.zeros(layers)
+        self.freq = np.zeros(layers)
+        self.gain = np.zeros(layers)
+        self.duty = np.full(layers, 0.5)
+
+        # -- LFOs, one per oscillator layer
+        self.lfo_on = np.zeros(layers, dtype=bool)
+        self.lfo_wave = np.zeros(layers, dtype=int)
+        self.lfo_phase = np.zeros(layers)
+        self.lfo_rate = np.zeros(layers)
+        self.lfo_depth = np.zeros(layers)
+        self.lfo_duty = np.full(layers, 0.5)
+        self.pwm_depth = np.zeros(layers) # LFO -> pulse width
+
+        # -- Envelope, times in frames
+        self.stage = np.full(n_slots, IDLE)
+        self.env_pos = np.zeros(n_slots, dtype=int)
+        self.attack = np.zeros(n_slots, dtype=int)
+        self.decay = np.zeros(n_slots, dtype=int)
+        self.sustain = np.zeros(n_slots)
+        self.release_frames = np.zeros(n_slots, dtype=int)
+        self.release_amp = np.zeros(n_slots)
+
+        self.note = np.full(n_slots, -1)
+        self.freed = [] # slots that went idle, drained by the allocator
+
+        # -- Noise, one generator per voice seeded from one sequence so a
+        # render with the same seed and notes is repeatable
+        self._seeds = np.random.SeedSequence(seed)
+        self.rngs = [None] * n_slots
+
+        # -- Preallocated render buffers
+        # sized for the largest oversampling factor
+        size = frames * max(OVERSAMPLE_FACTORS)
+        self._ramp = np.arange(size)
+        self._block = np.zeros((n_slots, size))
+        self._mix = np.zeros(size)
+
+        # -- Optional render threads, see render()
+        self.threads = max(1, threads)
+        self._partials = np.zeros((self.threads, size))
+        self._pool = None
+
+    @property
+    def n_active(self):
+        return np.count_nonzero(self.stage != IDLE)
+
+    def holds(self, slot, note):
+        """True if the slot is still playing the note (i.e. was not stolen)"""
+        return self.stage[slot] != IDLE and self.note[slot] == note
+
+    def note_on(self, slot, note, patch):
+        for layer, osc in enumerate(patch['osc']):
+            self.osc_on[slot, layer] = osc is not None
+            self.lfo_on[slot, layer] = False
+            self.pwm_depth[slot, layer] = 0.0
+            if osc is None:
+                continue
+
+            self.wave[slot, layer] = self.wave_codes[osc['wave']]
+            self.phase[slot, layer] = 0.0
+            self.freq[slot, layer] = self.freqs[note+osc['detune']]
+            self.gain[slot, layer] = NOTE_AMP * osc['gain']
+            self.duty[slot, layer] = osc['duty']
+
+            lfo = osc['lfo']
+            if lfo:
+                self.lfo_on[slot, layer] = True
+                self.lfo_wave[slot, layer] = self.wave_codes[lfo['wave']]
+                self.lfo_phase[slot, layer] = 0.0
+                self.lfo_rate[slot, layer] = lfo['rate']
+                self.lfo_depth[slot, layer] = lfo['depth']
+                self.lfo_duty[slot, layer] = lfo['duty']
+                self.pwm_depth[slot, layer] = lfo.get('pwm', 0.0)
+
+            # the oscillator or its LFO draws noise from the voice's generator
+            waves = (self.wave[slot, layer], self.lfo_wave[slot, layer] if lfo else None)
+            if self.noise_codes.intersection(waves):
+                self.rngs[slot] = np.random.default_rng(self._seeds.spawn(1)[0])
+
+        adsr = patch['adsr']
+        self.attack[slot] = int(self.sample_rate * adsr['Attack'])
+        self.decay[slot] = int(self.sample_rate * adsr['Decay'])
+        self.sustain[slot] = max(min(1.0, adsr['Sustain']), 0)
+        self.stage[slot] = ATTACK
+        self.env_pos[slot] = 0
+
+        self.note[slot] = note
+        return
+
+    def release(self, slot, release_time):
+        self.release_amp[slot] = self.level(slot)
+        self.release_frames[slot] = int(self.sample_rate * release_time)
+        self.env_pos[slot] = 0
+        if self.release_amp[slot] >= self.silence:
+            self.stage[slot] = RELEASE
+        else:
+            self.stage[slot] = IDLE
+            self.freed.append(slot)
+        return
+
+    def stop(self, slot):
+        """End a voice at once, e.g. one over a lowered voice limit"""
+        self.stage[slot] = IDLE
+        return
+
+    def level(self, slot):
+        """Current envelope value of a slot"""
+        return self.levels(np.array([slot]))[0]
+
+    def levels(self, rows):
+        """Current envelope values of the rows"""
+        return self._envelope(rows, self.env_pos[rows, None])[:, 0]
+
+    def _envelope(self, rows, t):
+        """Envelope of each row at positions t (rows x frames).
+
+        Matches the np.linspace segments of the reference Envelope in bench.py.
+        """
+        A = self.attack[rows, None]
+        D = self.decay[rows, None]
+        S = self.sustain[rows, None]
+        ads = np.where(
+            t < A,
+            t / np.maximum(A-1, 1),
+            np.where(t < A+D, 1 + (S-1) * (t-A) / np.maximum(D-1, 1), S)
+        )
+
+        R = self.release_frames[rows, None]
+        rel = np.where(t < R, self.release_amp[rows, None] * (1 - t / np.maximum(R-1, 1)), 0.0)
+
+        return np.where(self.stage[rows, None] == RELEASE, rel, ads)
+
+    def _waveform(self, codes, phase, inc, duty, rows):
+        """Apply each row's waveform (by code) to its row of phase; noise
+        rows draw from their voice's generator"""
+        out = np.empty_like(phase)
+        for code in np.unique(codes):
+            sel = codes == code
+            if code in self.noise_codes:
+                for i in np.flatnonzero(sel):
+                    out[i] = self.rngs[rows[i]].uniform(-1, 1, phase.shape[1])
+                continue
+            out[sel] = self.shapes[code](phase[sel], inc[sel], duty[sel])
+        return out
+
+    def _advance(self, rows, layer, frames, sample_rate):
+        """Phase and phase increment blocks of one oscillator layer for the
+        rows at sample_rate, LFOs included, and the unscaled LFO block (None
+        without LFOs)"""
+        ramp = self._ramp[:frames]
+        phase0 = self.phase[rows, layer]
+        freq = self.freq[rows, layer, None]
+        lfo = self.lfo_on[rows, layer]
+
+        if lfo.any():
+            lrows = rows[lfo]
+            l_inc = self.lfo_rate[lrows, layer] / sample_rate
+            l_phase = self.lfo_phase[lrows, layer, None] + l_inc[:, None] * ramp
+            self.lfo_phase[lrows, layer] = (self.lfo_phase[lrows, layer] + l_inc * frames) % 1.0
+
+            mod = np.zeros((rows.size, frames))
+            mod[lfo] = self._waveform(
+                self.lfo_wave[lrows, layer], l_phase, l_inc[:, None], self.lfo_duty[lrows, layer, None], lrows
+            )
+
+            inc = (freq + self.lfo_depth[rows, layer, None] * mod) / sample_rate
+            phase = phase0[:, None] + np.cumsum(inc, axis=1) - inc
+            self.phase[rows, layer] = (phase0 + inc.sum(axis=1)) % 1.0
+        else:
+            mod = None
+            inc = freq / sample_rate
+            phase = phase0[:, None] + inc * ramp
+            self.phase[rows, layer] = (phase0 + inc[:, 0] * frames) % 1.0
+
+        return phase, inc, mod
+
+    def _update_stages(self, active):
+        pos = self.env_pos[active]
+        A = self.attack[active]
+        D = self.decay[active]
+
+        # released voices end when the ramp runs out or drops below silence
+        R = self.release_frames[active]
+        rel = self.release_amp[active] * (1 - pos / np.maximum(R-1, 1))
+        sounding = (pos < R) & (rel >= self.silence)
+
+        released = self.stage[active] == RELEASE
+        self.stage[active] = np.where(
+            released,
+            np.where(sounding, RELEASE, IDLE),
+            np.where(pos < A, ATTACK, np.where(pos < A+D, DECAY, SUSTAIN))
         )
-        self._release = True
+        self.freed.extend(active[released & ~sounding].tolist())
         return
 
-    def get_audio_data(self, frames):
-        samples = np.zeros(frames)
+    def _render_rows(self, active, block, frames, factor, partial=None):
+        """Render the voices in active into block (one row each), at factor
+        times the sample rate; with partial given, also sum them into it"""
+        n = frames * factor
+        block[:] = 0
+        for layer in range(2):
+            idx = np.flatnonzero(self.osc_on[active, layer])
+            if not idx.size:
+                continue
+
+            rows = active[idx]
+            phase, inc, mod = self._advance(rows, layer, n, self.sample_rate * factor)
+            duty = self.duty[rows, layer, None]
+            pwm = self.pwm_depth[rows, layer, None]
+            if mod is not None and pwm.any():
+                duty = pwm_duty(duty, pwm * mod)
+
+            block[idx] += self.gain[rows, layer, None] * self._waveform(
+                self.wave[rows, layer], phase, inc, duty, rows
+            )
+
+        # envelope positions stay in base rate frames, fractional in between
+        t = self._ramp[:n] / factor if factor > 1 else self._ramp[:n]
+        block *= self._envelope(active, self.env_pos[active, None] + t)
+        if partial is not None:
+            block.sum(axis=0, out=partial)
+        return
 
-        if self._osc2:
-            samples += [
-                next(self._osc1) * self._gain1 + next(self._osc2) * self._gain2 
-                for _ in range(frames)
-            ]
+    def render(self, frames, factor=1):
+        """Render every active voice; finished voices free their slot.
+
+        Returns rows whose sum is the block, one per voice or one partial
+        mix per render thread, for mix(). With factor > 1 the block is
+        rendered oversampled, frames * factor samples at factor times the
+        sample rate; the caller decimates.
+        """
+        n = frames * factor
+        active = np.flatnonzero(self.stage != IDLE)
+        block = self._block[:active.size, :n]
+        if not active.size:
+            return block
+
+        n_chunks = min(self.threads, active.size // MIN_THREAD_VOICES)
+        if n_chunks < 2:
+            self._render_rows(active, block, frames, factor)
+            rows = block
         else:
-            samples += [next(self._osc1) * self._gain1 for _ in range(frames)]
-                
-        samples *= [next(self._envelope) for _ in range(frames)]
-        
-        return samples 
-   
+            # each chunk of voices owns its rows of block and its partial mix;
+            # numpy releases the GIL in the array ops so the chunks overlap
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.threads - 1, thread_name_prefix='voices')
+
+            bounds = np.linspace(0, active.size, n_chunks+1).astype(int)
+            rows = self._partials[:n_chunks, :n]
+            jobs = [
+                self._pool.submit(self._render_rows, active[a:b], block[a:b], frames, factor, rows[i])
+                for i, (a, b) in enumerate(zip(bounds[1:-1], bounds[2:]), start=1)
+            ]
+            self._render_rows(active[:bounds[1]], block[:bounds[1]], frames, factor, rows[0])
+            for job in jobs:
+                job.result()
+
+        self.env_pos[active] += frames
+        self._update_stages(active)
+        return rows
+
+    def mix(self, rows):
+        """Sum the rows from render() into one block with a single reduction"""
+        mix = self._mix[:rows.shape[1]]
+        rows.sum(axis=0, out=mix)
+        return mix
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        return
+
  
 # ----------------------------------
 
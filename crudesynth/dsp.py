@@ -1,3 +1,4 @@
+import abc
 import math
 from random import uniform
 
@@ -99,7 +100,7 @@ def pulse_wave(frequency, modulator=None, depth=0, duty_cycle=0.5, depth_D=0, d_
 
         yield sample
 
-        phasor_ += (frequency+vib_F)/44100 # steps += step_size
+        phasor_ += (frequency+vib_F)/SAMPLE_RATE # steps += step_size
         if phasor_ > 1.0:
             phasor_ = 0
 
@@ -111,48 +112,396 @@ def noise(frequency, modulator=None, depth=None):
     while True:
         yield uniform(-1, 1)
 
-# ========================= #
-# -- Envelope Generators -- #
-# ========================= #
-def ADSEnvelope(attack_time, decay_time, sustain=0.5, sample_rate=SAMPLE_RATE):
-        # max frames is 44100 == 1 sec
-        sustain = max(min(1.0, sustain), 0)
-
-        attack_frames = int(sample_rate * attack_time)
-        attack = np.linspace(0.0, 1.0, attack_frames)
-
-        decay_frames = int(sample_rate * decay_time)
-        decay = np.linspace(1.0, sustain, decay_frames)
+# =========================================================
+#                 Block Oscillators
+# =========================================================
+class BlockOscillator(abc.ABC):
+    '''Renders a whole block of samples per call from a phase accumulator.
+
+    Same waveforms as the generators above, but the phase is carried over
+    between blocks instead of being stepped one sample at a time.
+    '''
+    duty_cycle = 0.5
+
+    def __init__(self, frequency, modulator=None, depth=0, sample_rate=SAMPLE_RATE):
+        self.frequency = frequency
+        self.modulator = modulator
+        self.depth = depth or 0
+        self.sample_rate = sample_rate
+        self.phase = 0.0
+
+    def advance(self, frames):
+        '''Return the phase of every sample in the block and the phase
+        increment (cycles per sample), and step the accumulator'''
+        if self.modulator:
+            # LFO block added to the carrier frequency, integrated into phase
+            vib = self.modulator.render(frames) * self.depth
+            inc = (self.frequency + vib) / self.sample_rate
+            phase = self.phase + np.cumsum(inc) - inc
+            self.phase = (self.phase + inc.sum()) % 1.0
+        else:
+            inc = self.frequency / self.sample_rate
+            phase = self.phase + inc * np.arange(frames)
+            self.phase = (self.phase + inc * frames) % 1.0
+
+        return phase, inc
+
+    # Waveforms are static so the same shapes can be applied to a 2-D
+    # (voices x frames) phase array, see VoiceBank in core.py.
+    # inc is a scalar, or broadcasts against phase.
+    @staticmethod
+    @abc.abstractmethod
+    def shape(phase, inc, duty):
+        """Samples for phase, defined by every waveform"""
+
+    def render(self, frames):
+        phase, inc = self.advance(frames)
+        return self.shape(phase, inc, self.duty_cycle)
+
+class SineOscillator(BlockOscillator):
+    @staticmethod
+    def shape(phase, inc, duty):
+        return np.sin(2*np.pi*phase)
+
+class SawtoothOscillator(BlockOscillator):
+    @staticmethod
+    def shape(phase, inc, duty):
+        return 2 * (phase - np.floor(0.5+phase))
+
+class TriangleOscillator(BlockOscillator):
+    @staticmethod
+    def shape(phase, inc, duty):
+        return 2/np.pi * np.arcsin(np.sin(2*np.pi*phase))
+
+def pwm_duty(duty, vib):
+    """Duty cycle moved by vib, left unmodulated where that would leave
+    0.05-0.95 (as in pulse_wave)"""
+    mod = duty + vib
+    return np.where((mod > 0.95) | (mod < 0.05), duty, mod)
+
+class PulseOscillator(BlockOscillator):
+    def __init__(self, frequency, modulator=None, depth=0, duty_cycle=0.5, depth_D=0, d_mod=None,
+                 sample_rate=SAMPLE_RATE):
+        super().__init__(frequency, modulator, depth, sample_rate)
+        self.duty_cycle = duty_cycle
+        self.d_mod = d_mod # pulse width modulator
+        self.depth_D = depth_D
+
+    @staticmethod
+    def shape(phase, inc, duty):
+        # duty is a scalar or an array broadcasting against phase (PWM)
+        return np.where(phase % 1.0 < duty, 1.0, -1.0)
+
+    def render(self, frames):
+        phase, inc = self.advance(frames)
+        duty = self.duty_cycle
+        if self.d_mod:
+            duty = pwm_duty(duty, self.d_mod.render(frames) * self.depth_D)
+        return self.shape(phase, inc, duty)
+
+class NoiseOscillator(BlockOscillator):
+    """White noise from a numpy Generator; pass a seed for repeatable renders"""
+    def __init__(self, frequency=0, modulator=None, depth=0, seed=None, sample_rate=SAMPLE_RATE):
+        super().__init__(frequency, modulator, depth, sample_rate)
+        self.rng = np.random.default_rng(seed)
+
+    @staticmethod
+    def shape(phase, inc, duty, rng):
+        """Noise the shape of phase, drawn from rng (no shared default, so
+        every caller owns its stream)"""
+        return rng.uniform(-1, 1, np.shape(phase))
+
+    def render(self, frames):
+        return self.rng.uniform(-1, 1, frames)
 
-        for value in attack:
-            yield value
+# =========================================================
+#                 PolyBLEP Oscillators
+# =========================================================
+def poly_blep(t, dt):
+    """PolyBLEP residual of a -1 to +1 step at phase 0.
+
+    t is the phase in [0, 1), dt the phase increment (broadcasting against
+    t). The residual is only non zero within one sample either side of the
+    step, so only those samples are computed.
+    """
+    dt = np.broadcast_to(dt, np.shape(t))
+    out = np.zeros(np.shape(t))
+
+    i = np.nonzero(t < dt) # just after the step
+    x = t[i] / dt[i]
+    out[i] = x + x - x*x - 1
+
+    i = np.nonzero(t > 1 - dt) # just before the step
+    x = (t[i] - 1) / dt[i]
+    out[i] = x*x + x + x + 1
+    return out
+
+class BlepSawOscillator(SawtoothOscillator):
+    @staticmethod
+    def shape(phase, inc, duty):
+        # same phase as the naive saw, which drops at phase 0.5
+        t = (phase + 0.5) % 1.0
+        return 2*t - 1 - poly_blep(t, inc)
+
+class BlepPulseOscillator(PulseOscillator):
+    @staticmethod
+    def shape(phase, inc, duty):
+        t = phase % 1.0
+        out = np.where(t < duty, 1.0, -1.0)
+        out += poly_blep(t, inc) # rising edge at 0
+        out -= poly_blep((t - duty) % 1.0, inc) # falling edge at duty
+        return out
 
-        for value in decay:
-            yield value
+# =========================================================
+#                 Wavetable Oscillators
+# =========================================================
+TABLE_SIZE = 2048
+TABLE_LEVELS = 11 # level m keeps TABLE_SIZE/2 >> m harmonics
+
+# Sine series amplitudes of harmonic k for the naive waveforms above
+harmonic_amps = {
+    'sawtooth': lambda k: 2/np.pi * (-1.0)**(k+1) / k,
+    'square': lambda k: np.where(k % 2, 4/np.pi / k, 0.0),
+    'triangle': lambda k: np.where(k % 2, 8/np.pi**2 * (-1.0)**((k-1)//2) / k**2, 0.0),
+}
+
+_wavetables = {}
+
+def wavetable(wave, level):
+    """Band-limited single cycle table, built on first use and shared.
+
+    Level m holds the harmonics that stay below Nyquist for a phase
+    increment up to 2**m / TABLE_SIZE. One guard sample is appended for
+    interpolation.
+    """
+    table = _wavetables.get((wave, level))
+    if table is None:
+        harmonics = min(TABLE_SIZE//2 >> level, TABLE_SIZE//2 - 1)
+        k = np.arange(1, harmonics+1)
+        spectrum = np.zeros(TABLE_SIZE//2 + 1, dtype=complex)
+        spectrum[k] = -0.5j * TABLE_SIZE * harmonic_amps[wave](k)
+
+        table = np.fft.irfft(spectrum, TABLE_SIZE)
+        table = np.append(table, table[0])
+        table.setflags(write=False)
+        _wavetables[(wave, level)] = table
+
+    return table
+
+def table_level(inc):
+    """Mip level for a (peak) phase increment"""
+    level = np.ceil(np.log2(np.maximum(np.abs(inc), 1e-12) * TABLE_SIZE))
+    return np.clip(level, 0, TABLE_LEVELS-1).astype(int)
+
+def table_lookup(table, phase):
+    """Linearly interpolated table read at fractional phase"""
+    idx = (phase % 1.0) * TABLE_SIZE
+    i = idx.astype(int)
+    frac = idx - i
+    return table[i] + frac * (table[i+1] - table[i])
+
+class WavetableOscillator(BlockOscillator):
+    '''Reads cached band-limited tables instead of computing the naive
+    waveform. The table is picked per block (and per voice row) from the
+    highest phase increment, so LFO sweeps stay below Nyquist too.'''
+    wave = None
+
+    @classmethod
+    def shape(cls, phase, inc, duty):
+        if np.ndim(phase) < 2:
+            return table_lookup(wavetable(cls.wave, table_level(np.max(inc))), phase)
+
+        levels = table_level(np.max(np.broadcast_to(inc, phase.shape), axis=-1))
+        out = np.empty_like(phase)
+        for level in np.unique(levels):
+            sel = levels == level
+            out[sel] = table_lookup(wavetable(cls.wave, level), phase[sel])
+        return out
 
-        while True:
-            yield sustain
+class WavetableSawOscillator(WavetableOscillator):
+    wave = 'sawtooth'
 
-def release_envelope(release_time, start_amp=0.5, sample_rate=SAMPLE_RATE):
-        release_frames = int(sample_rate * release_time)
-        release = np.linspace(start_amp, 0, release_frames)
+class WavetableSquareOscillator(WavetableOscillator):
+    wave = 'square'
 
-        for value in release:
-            yield value
+class WavetableTriangleOscillator(WavetableOscillator):
+    wave = 'triangle'
 
-        while True:
-            yield 0
+# ========================= #
+# -- Envelope Generators -- #
+# ========================= #
+# Envelope stages
+IDLE, ATTACK, DECAY, SUSTAIN, RELEASE = range(5)
 
 # ==================================================
+def lowpass_coefficients(cutoff, Q=0.707, sample_rate=SAMPLE_RATE):
+    """Normalized RBJ low-pass coefficients, vectorized over cutoff (Hz)"""
+    omega = hz_to_rad(np.asarray(cutoff, dtype=float)) / sample_rate
+    cosOmega = np.cos(omega)
+    alpha = np.sin(omega) / (2.0 * Q)
+    factor = 1.0 / (1 + alpha)
+
+    b0 = (1 - cosOmega) / 2 * factor
+    b = np.stack([b0, 2*b0, b0], axis=-1)
+    a = np.stack([-2 * cosOmega * factor, (1 - alpha) * factor], axis=-1)
+    return b, a
+
+def biquad_kernel(b, a, size):
+    """Matrices that run a transposed direct form II biquad over `size`
+    samples at once.
+
+    With the filter state w as a 2-vector, a sub-block x gives
+        y  = T @ x + O @ w
+        w' = K @ x + A^size @ w
+    `powers` holds A^0 .. A^size so shorter tails can reuse the same kernel.
+    b and a may carry leading batch axes (one coefficient set per sub-block).
+    """
+    b = np.asarray(b)
+    a = np.asarray(a)
+    batch = b.shape[:-1]
+    b0, b1, b2 = b[..., 0], b[..., 1], b[..., 2]
+    a1, a2 = a[..., 0], a[..., 1]
+
+    # state update matrix A = [[-a1, 1], [-a2, 0]], input vector B
+    B = np.stack([b1 - a1*b0, b2 - a2*b0], axis=-1)
+    a1 = a1[..., None]
+    a2 = a2[..., None]
+
+    powers = np.empty(batch + (size+1, 2, 2))
+    powers[..., 0, :, :] = np.eye(2)
+    for k in range(size):
+        # A @ A^k written out, cheaper than a stacked matmul of 2x2s
+        powers[..., k+1, 0, :] = powers[..., k, 1, :] - a1 * powers[..., k, 0, :]
+        powers[..., k+1, 1, :] = -a2 * powers[..., k, 0, :]
+
+    # impulse response -> lower triangular Toeplitz matrix
+    h = np.empty(batch + (size,))
+    h[..., 0] = b0
+    h[..., 1:] = np.einsum('...kj,...j->...k', powers[..., :size-1, 0, :], B)
+    lag = np.subtract.outer(np.arange(size), np.arange(size))
+    T = np.where(lag >= 0, h[..., np.maximum(lag, 0)], 0.0)
+
+    O = powers[..., :size, 0, :].copy()
+    K = np.einsum('...kij,...j->...ik', powers[..., size-1::-1, :, :], B)
+
+    return T, O, K, powers
+
+def carry_state(w, step, inputs):
+    """State at the start of each sub-block: w <- step @ w + input.
+
+    step is one 2x2 matrix or one per sub-block. Plain floats, since this
+    is the only serial part of the block kernels.
+    """
+    w0, w1 = float(w[0]), float(w[1])
+    steps = np.broadcast_to(step, (len(inputs), 2, 2)).reshape(-1, 4).tolist()
+    states = []
+    for (s00, s01, s10, s11), (x0, x1) in zip(steps, inputs.tolist()):
+        states.append((w0, w1))
+        w0, w1 = s00*w0 + s01*w1 + x0, s10*w0 + s11*w1 + x1
+
+    return np.array(states)
 
 class BiQuadBase:
+    # samples per sub-block of the block-recursive kernel
+    SUB_BLOCK = 32
+    # samples per sub-block of the time-varying kernel (modulated cutoff)
+    MOD_SUB_BLOCK = 16
+
     def __init__(self):
         self.bCoef = np.array([0.0, 0.0, 0.0])
         self.aCoef = np.array([0.0, 0.0])
         self.w = np.array([0.0, 0.0])
-        
+        self._kernel = None
         
     def process(self, samples):
+        """Filter samples in place, sub-block at a time.
+
+        Same output and state (w) as process_direct, without the per-sample loop.
+        """
+        if self._kernel is None:
+            self._kernel = biquad_kernel(self.bCoef, self.aCoef, self.SUB_BLOCK)
+        T, O, K, powers = self._kernel
+
+        size = self.SUB_BLOCK
+        full = len(samples) // size * size
+        w = self.w.copy()
+
+        if full:
+            X = samples[:full].reshape(-1, size)
+            Y = X @ T.T
+            XK = X @ K.T # input contribution to the state of each sub-block
+
+            # only the state has to be carried through serially
+            W = carry_state(w, powers[size], XK)
+            w = W[-1] @ powers[size].T + XK[-1]
+
+            Y += W @ O.T
+            samples[:full] = Y.ravel()
+
+        rest = len(samples) - full
+        if rest:
+            x = samples[full:]
+            y = T[:rest, :rest] @ x + O[:rest] @ w
+            w = powers[rest] @ w + K[:, size-rest:] @ x
+            samples[full:] = y
+
+        self.w[:] = w
+        return samples
+
+    def process_modulated(self, samples, b, a):
+        """Filter samples in place with one coefficient set per sample.
+
+        b and a are (len(samples), 3) and (len(samples), 2). The
+        MOD_SUB_BLOCK sized sub-blocks are run side by side one sample
+        position at a time, from zero state and for a unit start state;
+        only the state is then carried through serially, as in process.
+        """
+        size = self.MOD_SUB_BLOCK
+        full = len(samples) // size * size
+        n = full // size
+        w = self.w.copy()
+
+        if full:
+            X = samples[:full].reshape(n, size)
+            b0, b1, b2 = (b[:full, i].reshape(n, size) for i in range(3))
+            a1, a2 = (a[:full, i].reshape(n, size) for i in range(2))
+
+            Y = np.empty((n, size))
+            O = np.empty((n, size, 2)) # output per unit start state
+            x0 = np.zeros(n) # state from the input alone
+            x1 = np.zeros(n)
+            s0 = np.tile([1.0, 0.0], (n, 1)) # state from a unit start state
+            s1 = np.tile([0.0, 1.0], (n, 1))
+            for j in range(size):
+                x = X[:, j]
+                y = b0[:, j] * x + x0
+                x0, x1 = b1[:, j] * x - a1[:, j] * y + x1, b2[:, j] * x - a2[:, j] * y
+                Y[:, j] = y
+
+                O[:, j] = s0
+                s0, s1 = s1 - a1[:, j, None] * s0, -a2[:, j, None] * s0
+
+            step = np.stack([s0, s1], axis=1)
+            XK = np.stack([x0, x1], axis=1)
+            W = carry_state(w, step, XK)
+            w = step[-1] @ W[-1] + XK[-1]
+
+            Y += np.einsum('nij,nj->ni', O, W)
+            samples[:full] = Y.ravel()
+
+        # the short tail sample by sample
+        w0, w1 = float(w[0]), float(w[1])
+        for i in range(full, len(samples)):
+            x = samples[i]
+            y = b[i, 0] * x + w0
+            w0, w1 = b[i, 1] * x - a[i, 0] * y + w1, b[i, 2] * x - a[i, 1] * y
+            samples[i] = y
+
+        self.w[:] = w0, w1
+        return samples
+
+    def process_direct(self, samples):
+        """Per-sample reference loop"""
         out = 0
         for s in range(len(samples)):
             out = self.bCoef[0] * samples[s] + self.w[0]
@@ -172,6 +521,7 @@ class BiQuadBase:
     def set_coefs(self, b, a):
         self.bCoef = b
         self.aCoef = a
+        self._kernel = None
     
 class RBJFilter(BiQuadBase):
     def __init__(self, cutoff = 1, sampleRate = 44100):
@@ -222,10 +572,60 @@ class RBJFilter(BiQuadBase):
     def get_cutoff(self):
         return self.cutoff    
 
+    def set_sample_rate(self, sample_rate):
+        """Run at another rate (e.g. oversampled), same cutoff and state"""
+        self.sampleRate = sample_rate
+        self.set_cutoff(self.cutoff)
 
+    def process_cutoff(self, samples, cutoff):
+        """Filter with a per-sample cutoff array (Hz), e.g. from an LFO.
 
+        Coefficients are computed for every sample, so they never step.
+        """
+        b, a = lowpass_coefficients(cutoff, self.Q, self.sampleRate)
+        return self.process_modulated(samples, b, a)
 
 
+# ==================================================
+#                 Oversampling
+# ==================================================
+class Decimator:
+    """Low-pass and downsample by factor with a polyphase FIR.
+
+    The Kaiser windowed sinc is split into factor phases of taps_per_phase
+    taps; each phase is convolved with its own decimated input stream, so
+    only the kept outputs are computed. The last input samples are carried
+    over so blocks join without clicks. Input blocks must be a multiple of
+    factor long.
+    """
+    def __init__(self, factor, taps_per_phase=48, beta=7.0):
+        self.factor = factor
+        n = factor * taps_per_phase
+        k = np.arange(n) - (n-1)/2
+        cutoff = 0.48 / factor # cycles per (oversampled) sample, ~21 kHz at 44.1k
+        h = 2*cutoff * np.sinc(2*cutoff*k) * np.kaiser(n, beta)
+        h /= h.sum()
+
+        # phase p holds taps p, p+factor, ... and sees input stream factor-1-p
+        self.phases = h.reshape(taps_per_phase, factor).T.copy()
+        self.taps = h
+        self._history = np.zeros((taps_per_phase-1) * factor)
+
+    def reset(self):
+        self._history[:] = 0
+        return
+
+    def process(self, samples):
+        factor = self.factor
+        ext = np.concatenate([self._history, samples])
+        streams = ext.reshape(-1, factor) # column q is x[m*factor + q]
+
+        out = np.convolve(streams[:, factor-1], self.phases[0], 'valid')
+        for p in range(1, factor):
+            out += np.convolve(streams[:, factor-1-p], self.phases[p], 'valid')
+
+        self._history[:] = ext[len(ext)-len(self._history):]
+        return out
 
 
 #
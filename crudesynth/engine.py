@@ -0,0 +1,483 @@
+import collections
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from allocator import VoiceAllocator
+from core import ControlOscillator, VoiceBank
+from dsp import RBJFilter, Decimator
+from perf import Profiler
+from tracelog import Tracer
+from settings import (
+    BUFFER_SIZE, SAMPLE_RATE, MAX_VOICES, RENDER_AHEAD, RENDER_THREADS, ENGINE_CPU, OVERSAMPLE_FACTORS
+)
+
+# -----------------------------
+def _plain(value):
+    """Numbers, strings, None and tuples of them"""
+    if isinstance(value, tuple):
+        return all(_plain(v) for v in value)
+    return value is None or isinstance(value, (bool, int, float, str, np.number, np.bool_))
+
+class Remote:
+    """GUI side stand-in for an engine object.
+
+    Setting an attribute or calling a method posts a command to the engine
+    instead of touching the object, so the GUI thread never mutates audio
+    state. The last value set is mirrored locally so the GUI can read it
+    back; names in `local` stay on the GUI side only (e.g. widgets, rects).
+    Only methods of `cls` (the target's class) can be called; reading any
+    other name that is not mirrored raises AttributeError.
+    """
+    def __init__(self, send, target, state=None, local=(), cls=object):
+        object.__setattr__(self, '_send', send)
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_cls', cls)
+        object.__setattr__(self, '_local', set(local))
+        object.__setattr__(self, '_mirror', dict(state or {}))
+
+    def __setattr__(self, name, value):
+        self._mirror[name] = value
+        if name not in self._local:
+            self._send(('set', self._target, name, value))
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        mirror = self._mirror
+        if name in mirror:
+            return mirror[name]
+        if not callable(getattr(self._cls, name, None)):
+            raise AttributeError(f'{self._cls.__name__} remote has no value or method {name!r}')
+
+        def call(*args):
+            self._send(('call', self._target, name, args))
+        return call
+
+
+# -----------------------------
+class AudioEngine:
+    """Owns the voices, the filter and its LFO and renders audio blocks.
+
+    The GUI talks to it through Remote objects; their commands are queued
+    and applied at the start of the next block by whichever thread renders
+    (the sounddevice callback, or the main loop in blocking mode).
+    """
+    def __init__(self, freqs, gen_funcs, block_size=BUFFER_SIZE, sample_rate=SAMPLE_RATE, threads=RENDER_THREADS,
+                 seed=None):
+        self.block_size = block_size
+        self.sample_rate = sample_rate
+
+        self.bank = VoiceBank(MAX_VOICES, freqs, gen_funcs, block_size, sample_rate, threads=threads, seed=seed)
+        self.allocator = VoiceAllocator(self.bank)
+        self.voice_filter = RBJFilter(250, sample_rate)
+        self.filter_lfo = ControlOscillator()
+        self.filter_on = False
+        self.base_gain = 0.4
+        self.gain = 0.5
+
+        self.cutoff = None # last cutoff from the filter LFO, for the GUI
+        self.underflows = 0
+        self.tracer = None # per-block trace, see trace()
+
+        # block timing: queued commands (notes, patch changes), filter LFO,
+        # voice render, voice sum, filter, decimation + output gain
+        self.profiler = Profiler(block_size / sample_rate, ('commands', 'lfo', 'voices', 'mix', 'filter', 'output'))
+
+        self._decimators = {factor: Decimator(factor) for factor in OVERSAMPLE_FACTORS if factor > 1}
+        self._oversample = 1
+
+        self._commands = collections.deque() # append/popleft are thread safe
+        self._out = np.zeros(block_size, dtype='float32')
+
+    @property
+    def oversample(self):
+        """Oversampling factor of the oscillator + filter chain"""
+        return self._oversample
+
+    @oversample.setter
+    def oversample(self, factor):
+        factor = int(factor)
+        if factor not in OVERSAMPLE_FACTORS:
+            raise ValueError(f'oversample must be one of {OVERSAMPLE_FACTORS}')
+        if factor != self._oversample:
+            self._oversample = factor
+            self.voice_filter.set_sample_rate(self.sample_rate * factor)
+            if factor > 1:
+                self._decimators[factor].reset()
+        return
+
+    # ------- Commands
+    def send(self, command):
+        self._commands.append(command)
+
+    def remote(self, target=None, local=(), send=None):
+        """Remote for the engine itself or one of its attributes by name.
+        Commands go to send, this engine's queue by default."""
+        obj = self if target is None else getattr(self, target)
+        cls = type(obj)
+        # plain values only: live objects (bank, allocator...) must not
+        # reach the GUI thread
+        names = [k for k in vars(obj) if not k.startswith('_')]
+        names += [k for k in dir(cls) if not k.startswith('_') and isinstance(getattr(cls, k), property)]
+        state = {}
+        for name in names:
+            value = getattr(obj, name)
+            if _plain(value):
+                state[name] = value
+        return Remote(send or self.send, target, state, local, cls)
+
+    def apply_commands(self):
+        commands = self._commands
+        while commands:
+            kind, target, name, value = commands.popleft()
+            obj = self if target is None else getattr(self, target)
+            if kind == 'set':
+                setattr(obj, name, value)
+            else:
+                getattr(obj, name)(*value)
+        return
+
+    def set_patch(self, patch):
+        """Apply the global (non per-voice) part of a patch, see offline.py"""
+        self.gain = patch['gain']
+        self.allocator.limit = patch['voices']
+        self.allocator.retrigger = patch['retrigger']
+        self.allocator.policy = patch['steal']
+        self.oversample = patch['oversample']
+
+        filt = patch['filter']
+        self.filter_on = filt['on']
+        self.voice_filter.set_cutoff(filt['cutoff'])
+
+        lfo = filt['lfo']
+        self.filter_lfo.on = lfo is not None
+        if lfo:
+            self.filter_lfo.lfo_func = lfo['wave']
+            self.filter_lfo.rate = lfo['rate']
+            self.filter_lfo.depth = lfo['depth']
+            self.filter_lfo.center_freq = lfo['center']
+        return
+
+    # ------- Voices
+    def note_on(self, note, patch):
+        slot = self.allocator.note_on(note)
+        self.bank.note_on(slot, note, patch)
+        return
+
+    def note_off(self, note, release_time):
+        for slot in self.allocator.note_off(note):
+            self.bank.release(slot, release_time)
+        return
+
+    # ------- Audio
+    def trace(self, path):
+        """Record every block to path from now on, see tracelog.py"""
+        self.tracer = Tracer(path)
+        self.tracer.start()
+        return
+
+    def render(self, frames):
+        """Next block of output samples (float32, owned by the engine)"""
+        out = self._render(frames)
+        if self.tracer is not None:
+            self.tracer.record(self, self.profiler.last(), self.profiler.budget)
+        return out
+
+    def _render(self, frames):
+        prof = self.profiler
+        start = prof.begin()
+        self.apply_commands()
+        t = prof.lap('commands', start)
+
+        out = self._out[:frames]
+        if not self.bank.n_active:
+            out[:] = 0
+            prof.end(start)
+            return out
+
+        factor = self._oversample
+        cutoff = None
+        if self.filter_lfo.on and self.filter_lfo._gen:
+            cutoff = self.filter_lfo.render(frames)
+            self.cutoff = cutoff[-1]
+            # the knob no longer sends it back; the filter keeps the last
+            # value when the LFO is switched off
+            self.voice_filter.set_cutoff(self.cutoff)
+            if factor > 1:
+                cutoff = np.repeat(cutoff, factor)
+        t = prof.lap('lfo', t)
+
+        # finished voices free their slot inside render
+        rows = self.bank.render(frames, factor)
+        t = prof.lap('voices', t)
+        samples = self.bank.mix(rows)
+        t = prof.lap('mix', t)
+
+        if self.filter_on:
+            if cutoff is not None:
+                samples = self.voice_filter.process_cutoff(samples, cutoff)
+            else:
+                samples = self.voice_filter.process(samples)
+        t = prof.lap('filter', t)
+
+        if factor > 1:
+            samples = self._decimators[factor].process(samples)
+
+        np.multiply(samples, self.base_gain * self.gain, out=out)
+        prof.lap('output', t)
+        prof.end(start)
+        return out
+
+    def stats(self):
+        """Rolling DSP load, worst block, stage times (ms) and underflows"""
+        return dict(self.profiler.stats(), underflows=self.underflows)
+
+    def callback(self, outdata, frames, time, status):
+        """sounddevice OutputStream callback"""
+        if status.output_underflow:
+            self.underflows += 1
+        outdata[:, 0] = self.render(frames)
+        return
+
+    def close(self):
+        self.bank.close()
+        if self.tracer is not None:
+            self.tracer.stop()
+        return
+
+
+# -----------------------------
+class RingBuffer:
+    """Single producer / single consumer ring of float32 samples.
+
+    `index` holds the total samples written and read so far; each side only
+    advances its own counter, after touching the data, so no lock is needed.
+    buffer/index may be passed in, e.g. views on shared memory.
+    """
+    def __init__(self, capacity, buffer=None, index=None):
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype='float32') if buffer is None else buffer
+        self.index = np.zeros(2, dtype='int64') if index is None else index
+
+    @property
+    def available(self):
+        return int(self.index[0] - self.index[1])
+
+    @property
+    def space(self):
+        return self.capacity - self.available
+
+    def write(self, samples):
+        """Append samples, the caller checks there is space"""
+        n = len(samples)
+        start = int(self.index[0]) % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start:start+first] = samples[:first]
+        self.buffer[:n-first] = samples[first:]
+        self.index[0] += n
+        return
+
+    def read(self, out):
+        """Fill out from the ring, zero padded; returns the samples missing"""
+        n = min(len(out), self.available)
+        start = int(self.index[1]) % self.capacity
+        first = min(n, self.capacity - start)
+        out[:first] = self.buffer[start:start+first]
+        out[first:n] = self.buffer[:n-first]
+        out[n:] = 0
+        self.index[1] += n
+        return len(out) - n
+
+
+class RenderAhead:
+    """Keeps `depth` blocks rendered ahead of the stream.
+
+    A producer thread renders engine blocks into a ring buffer whenever
+    there is room for one; the stream callback only copies out of it. One
+    slow block is absorbed by the blocks already queued, at the cost of
+    depth * BUFFER_SIZE samples of extra latency.
+    """
+    def __init__(self, engine, depth=RENDER_AHEAD):
+        self.engine = engine
+        self.block_size = engine.block_size
+        self.ring = RingBuffer(depth * engine.block_size)
+        self.running = False
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+
+    def start(self):
+        """Fill the ring, so the first callback finds depth blocks, then
+        keep it topped up from the producer thread"""
+        while self.ring.space >= self.block_size:
+            self.ring.write(self.engine.render(self.block_size))
+        self.running = True
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        self._wake.set()
+        self._thread.join()
+
+    def _produce(self):
+        ring = self.ring
+        block = self.block_size
+        timeout = block / self.engine.sample_rate
+        while self.running:
+            if ring.space >= block:
+                ring.write(self.engine.render(block))
+            else:
+                self._wake.wait(timeout)
+                self._wake.clear()
+        return
+
+    def callback(self, outdata, frames, time, status):
+        """sounddevice OutputStream callback, drains the ring"""
+        missing = self.ring.read(outdata[:, 0])
+        if missing or status.output_underflow:
+            self.engine.underflows += 1
+        self._wake.set()
+        return
+
+
+# -----------------------------
+class EngineProcess:
+    """AudioEngine running in a child process ('process' audio mode).
+
+    The engine is built here and forked, so the GUI keeps a copy to mirror
+    the initial state for its Remotes. The child renders blocks into a
+    RingBuffer on shared memory and the stream callback in this process
+    only copies out of it; commands go over a queue. The GIL of the GUI
+    process is never needed to render audio. The child may be pinned to
+    one CPU (Linux).
+    """
+    def __init__(self, freqs, gen_funcs, depth=RENDER_AHEAD, cpu=ENGINE_CPU):
+        # fork, not spawn: spawn would re-run the app script in the child
+        ctx = multiprocessing.get_context('fork')
+
+        self.engine = AudioEngine(freqs, gen_funcs)
+        self.block_size = self.engine.block_size
+        self.sample_rate = self.engine.sample_rate
+        self.cpu = cpu
+        self.underflows = 0
+
+        # shared layout: ring index (2 x int64), status (float64): cutoff,
+        # underflows (for the trace) then the profiler values, samples (float32)
+        n_status = 2 + len(self.engine.profiler.fields())
+        capacity = depth * self.block_size
+        offset = 16 + 8*n_status
+        self._shm = shared_memory.SharedMemory(create=True, size=offset + 4*capacity)
+        buf = self._shm.buf
+        self._status = np.ndarray(n_status, dtype='float64', buffer=buf, offset=16)
+        self._status[:] = 0
+        self._status[0] = np.nan
+        self.ring = RingBuffer(
+            capacity,
+            buffer = np.ndarray(capacity, dtype='float32', buffer=buf, offset=offset),
+            index = np.ndarray(2, dtype='int64', buffer=buf, offset=0)
+        )
+        self.ring.index[:] = 0
+
+        self._commands = ctx.Queue()
+        self._running = ctx.Event()
+        self._process = ctx.Process(target=self._run, name='crudesynth-engine', daemon=True)
+
+    # ------- GUI side
+    def send(self, command):
+        self._commands.put(command)
+
+    def remote(self, target=None, local=()):
+        return self.engine.remote(target, local, send=self.send)
+
+    @property
+    def cutoff(self):
+        cutoff = self._status[0]
+        return None if np.isnan(cutoff) else float(cutoff)
+
+    def stats(self):
+        """As AudioEngine.stats, from the last values the child published"""
+        stats = self.engine.profiler.from_values(self._status[2:])
+        return dict(stats, underflows=self.underflows)
+
+    def trace(self, path):
+        """As AudioEngine.trace, recorded by the child; call before start"""
+        self.engine.tracer = Tracer(path) # its writer starts in the child
+        return
+
+    def start(self, timeout=2.0):
+        """Start the child and wait until it has filled the ring"""
+        self._running.set()
+        self._process.start()
+        deadline = time.monotonic() + timeout
+        while self.ring.space >= self.block_size and time.monotonic() < deadline:
+            time.sleep(self.block_size / self.sample_rate / 4)
+
+    def close(self):
+        self._running.clear()
+        self._process.join(1)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._commands.close()
+
+        # drop the numpy views before releasing the buffer
+        self.ring = self._status = None
+        self._shm.close()
+        self._shm.unlink()
+        return
+
+    def callback(self, outdata, frames, time, status):
+        """sounddevice OutputStream callback, drains the shared ring"""
+        missing = self.ring.read(outdata[:, 0])
+        if missing or status.output_underflow:
+            self.underflows += 1
+            self._status[1] = self.underflows
+        return
+
+    # ------- Child process
+    def _run(self):
+        if self.cpu is not None and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, {self.cpu})
+
+        engine = self.engine
+        if engine.tracer is not None:
+            engine.tracer.start()
+        ring = self.ring
+        status = self._status
+        commands = self._commands
+        block = self.block_size
+        wait = block / self.sample_rate / 4
+        published = 0
+
+        while self._running.is_set():
+            if ring.space >= block:
+                engine.underflows = int(status[1])
+                ring.write(engine.render(block))
+                if engine.cutoff is not None:
+                    status[0] = engine.cutoff
+
+                published += 1
+                if published % 8 == 0: # a few times a second is plenty for the GUI
+                    status[2:] = engine.profiler.values()
+            else:
+                try:
+                    engine.send(commands.get(timeout=wait))
+                except queue.Empty:
+                    pass
+
+            try:
+                while True:
+                    engine.send(commands.get_nowait())
+            except queue.Empty:
+                pass
+
+        engine.close()
+        return
+
+
+#
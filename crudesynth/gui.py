@@ -1,9 +1,11 @@
+import functools
 import math
 
 import pygame
 
-from widgets import Knob, ValueBox, DropDownMenu, Button, Toggle
-from settings import WIDTH, HEIGHT
+from widgets import Knob, ValueBox, DropDownMenu, Button, Toggle, mark_dirty
+from allocator import POLICIES
+from settings import WIDTH, HEIGHT, MAX_VOICES, OVERSAMPLE_FACTORS
 
 class Font:
     '''Font object for setting font parameters used in rendering'''
@@ -26,6 +28,11 @@ class Font:
 
         return [text, text_rect]
 
+@functools.lru_cache(maxsize=None)
+def load_image(path):
+    '''Image converted for the display, loaded once and shared by callers'''
+    return pygame.image.load(path).convert_alpha()
+
 # ------ Piano
 class PianoKey:
     def __init__(self, x, y, width, height, id_ = None, white_key=True, surface=None):
@@ -43,11 +50,11 @@ class PianoKey:
         self.rect = pygame.Rect(self.x, self.y, self.width, self.height)
 
         if surface != 'b':
-            self.nonactive_surface = pygame.image.load(f"./images/wkey_{surface}.png").convert_alpha()
-            self.active_surface = pygame.image.load(f"./images/wkey_{surface}_act.png").convert_alpha()
+            self.nonactive_surface = load_image(f"./images/wkey_{surface}.png")
+            self.active_surface = load_image(f"./images/wkey_{surface}_act.png")
         else:
-            self.nonactive_surface = pygame.image.load(f"./images/bkey.png").convert_alpha()
-            self.active_surface = pygame.image.load(f"./images/bkey_act.png").convert_alpha()
+            self.nonactive_surface = load_image(f"./images/bkey.png")
+            self.active_surface = load_image(f"./images/bkey_act.png")
 
     def draw(self):
         surface = pygame.display.get_surface()
@@ -55,6 +62,7 @@ class PianoKey:
             surface.blit(self.active_surface, self.rect)
         else:
             surface.blit(self.nonactive_surface, self.rect)
+        mark_dirty(self.rect)
 
 # ==================================
 def make_amp_adsr(amp_rect, adsr, controls, labels, value_boxes, font):
@@ -115,6 +123,14 @@ def make_lfo_panel(lfo_rect, lfo, controls, labels, value_boxes, font):
     drop_menu2.add_subscriber(obj=lfo, attr='lfo_func')
     controls.append(drop_menu2)
 
+    # -- Pulse width modulation
+    pwm_toggle = Toggle(lfo_rect.x+250, lfo_rect.y+5, 20, 20)
+    pwm_toggle.add_subscriber(obj=lfo, attr='pwm_on')
+    controls.append(pwm_toggle)
+
+    label = font.make_text("PWM", x=pwm_toggle.rect.right+25, y=lfo_rect.y+5)
+    labels.append(label)
+
     # -- Rate
     knob = Knob(x=lfo_rect.x+40, y=lfo_rect.y+60, radius=15, min_val=0.01, max_val=30)
     value_box = ValueBox(knob.value, x=knob.rect.centerx, y=knob.rect.centery+50, font=font, width=8)
@@ -275,7 +291,10 @@ def make_piano_keys():
 # =================================
 
 def make_osc1(osc, controls, labels, value_boxes, lfo1, font, font2):
-    generator_list = ['sine', 'sawtooth', 'triangle', 'pulse', 'noise']
+    generator_list = [
+        'sine', 'sawtooth', 'triangle', 'pulse', 'noise',
+        'blep saw', 'blep pulse', 'wt saw', 'wt square', 'wt triangle'
+    ]
 
     label = font.make_text("OSC1:", x=osc.rect.x, y=osc.rect.y+5)
     labels.append(label)
@@ -352,7 +371,10 @@ def make_osc1(osc, controls, labels, value_boxes, lfo1, font, font2):
 
 
 def make_osc2(osc, controls, labels, value_boxes, lfo2, font, font2):
-    generator_list = ['sine', 'sawtooth', 'triangle', 'pulse', 'noise']
+    generator_list = [
+        'sine', 'sawtooth', 'triangle', 'pulse', 'noise',
+        'blep saw', 'blep pulse', 'wt saw', 'wt square', 'wt triangle'
+    ]
 
     osc2_toggle = Toggle(osc.rect.x-35, osc.rect.y+5, 20, 20) # make a toggle button
     controls.append(osc2_toggle)
@@ -440,7 +462,7 @@ def make_filter_box(filter_rect, filter_lfo, voice_filter, controls, labels, val
     value_box = ValueBox(knobF.value, x=knobF.rect.centerx, y=knobF.rect.centery+50, font=font, width=12)
 
     knobF.add_subscriber(method=value_box.update)
-    knobF.add_subscriber(method=voice_filter.set_cutoff)
+    knobF.add_subscriber(method=voice_filter.set_cutoff, automated=False) # the filter LFO sets it in the engine
 
     label = font.make_text("Cutoff", x=knobF.rect.centerx, y=knobF.rect.centery+30)
     labels.append(label)
@@ -454,6 +476,7 @@ def make_filter_box(filter_rect, filter_lfo, voice_filter, controls, labels, val
     # -- Filter LFO
     #filter_lfo = ControlOscillator()
     filter_lfo.control = knobF
+    filter_lfo.limits = (knobF.min_val, knobF.max_val)
 
     filter_lfo_rect = pygame.Rect(WIDTH*0.50, HEIGHT*0.10, 400, 150)
     filter_lfo.rect = filter_lfo_rect
@@ -486,11 +509,11 @@ def make_filter_box(filter_rect, filter_lfo, voice_filter, controls, labels, val
 
 
 # ==============================================================================
-def make_voice_controls(controls, labels, value_boxes, font):
-    n_voices = {'val': 8}
-    knob = Knob(x=110, y=HEIGHT*0.55, radius=20, min_val=1, max_val=16, int_value=True)
-    knob.add_subscriber(obj=n_voices, attr='val', is_dict=True)
-    n_voices['val'] = knob.value
+def make_voice_controls(controls, labels, value_boxes, font, allocator):
+    # start at 8 voices as before, not mid-travel
+    knob = Knob(x=110, y=HEIGHT*0.55, radius=20, min_val=1, max_val=MAX_VOICES, int_value=True, value=8)
+    knob.add_subscriber(obj=allocator, attr='limit')
+    allocator.limit = knob.value
 
     value_box = ValueBox(
         knob.value,
@@ -512,12 +535,31 @@ def make_voice_controls(controls, labels, value_boxes, font):
     retrigger = Toggle(knob.rect.right + 20, knob.rect.centery, 20, 20) # make a toggle button
     label = font.make_text("Retrigger", x=retrigger.rect.right+50, y=retrigger.rect.centery-10)
     retrigger.active = True
+    retrigger.value = True
+    retrigger.add_subscriber(obj=allocator, attr='retrigger')
+    allocator.retrigger = True
 
     controls.append(retrigger) # need to track this...
     labels.append(label)
 
-    return controls, labels, value_boxes, retrigger, n_voices
+    # -- Voice stealing policy
+    label = font.make_text("Steal:", x=retrigger.rect.x+40, y=retrigger.rect.bottom+15)
+    labels.append(label)
+
+    drop_menu = DropDownMenu(list(POLICIES), retrigger.rect.x+70, retrigger.rect.bottom+15, font)
+    drop_menu.add_subscriber(obj=allocator, attr='policy')
+    allocator.policy = drop_menu.value
+    controls.append(drop_menu)
+
+    return controls, labels, value_boxes
 
 
+def make_oversample_menu(x, y, synth, controls, labels, font):
+    label = font.make_text("Oversample:", x=x+60, y=y)
+    labels.append(label)
+
+    drop_menu = DropDownMenu(list(OVERSAMPLE_FACTORS), x+130, y, font, width=40)
+    drop_menu.add_subscriber(obj=synth, attr='oversample')
+    controls.append(drop_menu)
 
-#
+    return controls, labels
@@ -0,0 +1,136 @@
+"""Headless rendering: bounce a patch and a timed note list to a WAV file.
+
+No display or audio device is needed. The same AudioEngine as the app is
+driven as fast as the CPU allows and blocks are written to the file as
+they are rendered.
+
+    python offline.py notes.json out.wav [--patch patch.json]
+
+notes.json is a list of [start_seconds, note, duration_seconds], note being
+an index into core.freqs (45 is A4). patch.json has the layout of
+DEFAULT_PATCH; missing top-level keys fall back to it.
+"""
+import argparse
+import json
+import time
+import wave
+
+import numpy as np
+
+from core import gen_funcs, freqs
+from engine import AudioEngine
+from settings import BUFFER_SIZE, SAMPLE_RATE
+
+DEFAULT_PATCH = {
+    # oscillator layers, the second may be None (off)
+    'osc': [
+        # lfo: None or {'wave', 'rate', 'depth', 'duty', 'pwm'}
+        {'wave': 'sawtooth', 'detune': 0, 'gain': 0.5, 'duty': 0.5, 'lfo': None},
+        None
+    ],
+    'adsr': {'Attack': 0.01, 'Decay': 0.2, 'Sustain': 0.5, 'Release': 0.3},
+    'filter': {
+        'on': False,
+        'cutoff': 250,
+        'lfo': None # or {'wave', 'rate', 'depth', 'center'}
+    },
+    'gain': 0.5,
+    'voices': 8,
+    'retrigger': True,
+    'steal': 'oldest', # see allocator.POLICIES
+    'oversample': 1 # 1, 2 or 4, for the oscillator + filter chain
+}
+
+# -----------------------------
+def note_events(notes, sample_rate=SAMPLE_RATE):
+    """[(frame, is_on, note)] in time order, note-offs first on ties.
+    Every note lasts at least one frame, so its note-off never sorts
+    before its own note-on."""
+    events = []
+    for start, note, duration in notes:
+        on = int(start * sample_rate)
+        events.append((on, True, note))
+        events.append((max(int((start + duration) * sample_rate), on + 1), False, note))
+    return sorted(events, key=lambda e: (e[0], e[1]))
+
+def render_to_wav(path, notes, patch=DEFAULT_PATCH, tail=None, sample_rate=SAMPLE_RATE, seed=0):
+    """Render notes with patch into a 16 bit mono WAV file.
+
+    Blocks are split at note events so timing is sample accurate. tail is
+    how long to keep rendering after the last note-off, default the release
+    time. seed makes noise repeatable, None draws fresh noise. Returns a
+    dict with the render statistics.
+    """
+    patch = dict(DEFAULT_PATCH, **patch)
+    if tail is None:
+        tail = patch['adsr']['Release']
+
+    engine = AudioEngine(freqs, gen_funcs, BUFFER_SIZE, sample_rate, seed=seed)
+    engine.set_patch(patch)
+
+    events = note_events(notes, sample_rate)
+    end = (events[-1][0] if events else 0) + int(tail * sample_rate)
+
+    started = time.perf_counter()
+    pos = 0
+    i = 0
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+
+        while pos < end:
+            while i < len(events) and events[i][0] <= pos:
+                _, is_on, note = events[i]
+                if is_on:
+                    engine.note_on(note, patch)
+                else:
+                    engine.note_off(note, patch['adsr']['Release'])
+                i += 1
+
+            frames = min(BUFFER_SIZE, end - pos)
+            if i < len(events):
+                frames = min(frames, events[i][0] - pos)
+
+            block = engine.render(frames)
+            wav.writeframes((np.clip(block, -1, 1) * 32767).astype('<i2').tobytes())
+            pos += frames
+
+    elapsed = time.perf_counter() - started
+    seconds = end / sample_rate
+    return {
+        'frames': end,
+        'seconds': seconds,
+        'elapsed': elapsed,
+        'realtime_factor': elapsed / seconds if seconds else 0.0, # < 1 is faster than real time
+    }
+
+
+# -----------------------------
+def main():
+    parser = argparse.ArgumentParser(description='Render a note list to a WAV file')
+    parser.add_argument('notes', help='JSON list of [start_seconds, note, duration_seconds]')
+    parser.add_argument('out', help='output WAV path')
+    parser.add_argument('--patch', help='JSON patch, see DEFAULT_PATCH')
+    parser.add_argument('--tail', type=float, help='seconds rendered after the last note-off')
+    parser.add_argument('--seed', type=int, default=0, help='noise seed')
+    args = parser.parse_args()
+
+    with open(args.notes) as f:
+        notes = json.load(f)
+
+    patch = {}
+    if args.patch:
+        with open(args.patch) as f:
+            patch = json.load(f)
+
+    stats = render_to_wav(args.out, notes, patch, args.tail, seed=args.seed)
+    print(
+        f"{stats['seconds']:.2f} s of audio in {stats['elapsed']:.2f} s, "
+        f"real-time factor {stats['realtime_factor']:.3f} "
+        f"({1/stats['realtime_factor'] if stats['realtime_factor'] else 0:.1f}x real time)"
+    )
+
+
+if __name__ == '__main__':
+    main()
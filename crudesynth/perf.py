@@ -0,0 +1,152 @@
+"""Block timing for the render loop and the GUI.
+
+A Profiler keeps the last `window` times of every stage in a small ring
+so the load figures are rolling rather than since start:
+
+    start = prof.begin()
+    ...                          # first stage
+    t = prof.lap('voices', start)
+    ...                          # next stage
+    t = prof.lap('filter', t)
+    prof.end(start)
+
+Load is the block time as a fraction of the budget (the block deadline,
+or the frame time for the GUI).
+"""
+import time
+
+import numpy as np
+
+perf_counter = time.perf_counter
+
+class Profiler:
+    def __init__(self, budget, stages, window=50):
+        self.budget = budget
+        self.stages = tuple(stages)
+        self.window = window
+
+        self._index = {name: i for i, name in enumerate(self.stages)}
+        self._times = np.zeros((len(self.stages) + 1, window)) # last row: whole block
+        self._count = 0
+        self.worst = 0.0 # longest block since reset, seconds
+
+    # ------- Timing
+    def begin(self):
+        return perf_counter()
+
+    def lap(self, stage, since):
+        """Add the time since `since` to stage for this block; returns now"""
+        now = perf_counter()
+        self._times[self._index[stage], self._count % self.window] += now - since
+        return now
+
+    def end(self, start):
+        total = perf_counter() - start
+        col = self._count % self.window
+        self._times[-1, col] = total
+        if total > self.worst:
+            self.worst = total
+
+        self._count += 1
+        self._times[:, self._count % self.window] = 0 # next block starts empty
+        return total
+
+    def last(self):
+        """Stage times and total of the last finished block, seconds"""
+        return self._times[:, (self._count - 1) % self.window]
+
+    def reset(self):
+        self._times[:] = 0
+        self._count = 0
+        self.worst = 0.0
+        return
+
+    # ------- Results
+    def _filled(self):
+        """Columns of finished blocks"""
+        if self._count < self.window:
+            return self._times[:, :self._count]
+        current = self._count % self.window
+        return np.delete(self._times, current, axis=1)
+
+    def stats(self):
+        """Rolling load, peak load in the window, worst block and the mean
+        time of every stage (ms)"""
+        times = self._filled()
+        if not times.shape[1]:
+            return {'load': 0.0, 'peak_load': 0.0, 'worst_ms': 0.0, 'stages': dict.fromkeys(self.stages, 0.0)}
+
+        means = times.mean(axis=1)
+        return {
+            'load': means[-1] / self.budget,
+            'peak_load': times[-1].max() / self.budget,
+            'worst_ms': self.worst * 1e3,
+            'stages': {name: means[i] * 1e3 for i, name in enumerate(self.stages)}
+        }
+
+    # flat form, e.g. for a shared memory status array
+    def fields(self):
+        return ('load', 'peak_load', 'worst_ms') + self.stages
+
+    def values(self):
+        stats = self.stats()
+        return [stats['load'], stats['peak_load'], stats['worst_ms']] + list(stats['stages'].values())
+
+    def from_values(self, values):
+        values = [float(v) for v in values]
+        return {
+            'load': values[0],
+            'peak_load': values[1],
+            'worst_ms': values[2],
+            'stages': dict(zip(self.stages, values[3:]))
+        }
+
+
+class FramePacer:
+    """GUI frame rate that backs off while the audio engine is pressed.
+
+    Fed the engine stats a few times a second: the rate halves (down to
+    min_fps) when the peak block load reaches `high` or an underflow was
+    counted, and doubles again (up to fps) once the peak has stayed under
+    `low` for `hold` seconds. At the lower rates the widgets' dirty rects
+    collect over more events and are pushed in one update per frame.
+    """
+    def __init__(self, fps, min_fps, high=0.8, low=0.5, hold=2.0):
+        self.max_fps = fps
+        self.min_fps = min_fps
+        self.high = high
+        self.low = low
+        self.hold = hold
+
+        self.fps = fps
+        self._underflows = 0
+        self._calm_since = None
+
+    def update(self, stats, now):
+        """Adjust the rate from engine stats; returns the rate"""
+        peak = stats['peak_load']
+        underflow = stats['underflows'] != self._underflows
+        self._underflows = stats['underflows']
+
+        if underflow or peak >= self.high:
+            self.fps = max(self.fps // 2, self.min_fps)
+            self._calm_since = None
+        elif peak < self.low:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.hold:
+                self.fps = min(self.fps * 2, self.max_fps)
+                self._calm_since = now
+        else:
+            self._calm_since = None
+        return self.fps
+
+
+def format_stats(stats, underflows=None):
+    """One line summary, e.g. for a periodic log"""
+    stages = ' '.join(f'{name} {ms:.2f}' for name, ms in stats['stages'].items())
+    line = (f"load {stats['load']:.0%} peak {stats['peak_load']:.0%} "
+            f"worst {stats['worst_ms']:.2f} ms | {stages} ms")
+    if underflows is not None:
+        line += f' | underflows {underflows}'
+    return line
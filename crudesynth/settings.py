@@ -2,8 +2,25 @@
 WIDTH = 1280	
 HEIGHT = 720
 FPS = 120
+MIN_FPS = 30 # the GUI drops towards this while the audio engine is near its deadline
+AUTOMATION_FPS = 30 # redraws of knobs moved by the filter LFO
 
 # DSP
 BUFFER_SIZE = 256*4
+RENDER_AHEAD = 2 # blocks queued ahead of the stream in 'ring' mode (2-8), ~23 ms each
 SAMPLE_RATE = 44100
 NOTE_AMP = 0.1
+MAX_VOICES = 64
+RENDER_THREADS = 1 # threads rendering voices, 1 = single threaded
+OVERSAMPLE_FACTORS = (1, 2, 4) # choices for the oscillator + filter chain
+SILENCE_LEVEL = 1e-4 # released voices end below this envelope level (-80 dB)
+
+# Audio
+# 'ring': engine renders RENDER_AHEAD blocks ahead in its own thread
+# 'callback': engine renders in the sounddevice callback thread
+# 'blocking': engine renders in the GUI loop (stream.write)
+# 'process': engine renders RENDER_AHEAD blocks ahead in a child process (needs fork, e.g. Linux)
+AUDIO_MODE = 'ring'
+ENGINE_CPU = None # CPU to pin the 'process' mode engine to (Linux), None = any
+PERF_LOG_INTERVAL = 0 # seconds between DSP load lines on stdout, 0 = off
+TRACE_PATH = None # file for a per-block engine trace (see tracelog.py), None = off
@@ -0,0 +1,84 @@
+"""Voice allocation when the Voices knob is lowered while notes are held.
+
+Run from the crudesynth directory with `python -m pytest -q`.
+"""
+import copy
+
+import pytest
+
+from allocator import POLICIES
+from core import freqs, gen_funcs
+from engine import AudioEngine
+from offline import DEFAULT_PATCH
+
+
+def held_notes(policy, retrigger, notes=(10, 11, 12, 13)):
+    engine = AudioEngine(freqs, gen_funcs, seed=0)
+    patch = copy.deepcopy(DEFAULT_PATCH)
+    patch.update(voices=8, steal=policy, retrigger=retrigger)
+    engine.set_patch(patch)
+    for note in notes:
+        engine.note_on(note, patch)
+        engine.render(256)
+    return engine, patch
+
+
+def check_books(allocator):
+    busy = set(allocator._playing) | set(allocator._released)
+    free = allocator._free
+    assert len(free) == len(set(free))
+    assert not busy & set(free)
+    assert all(slot < allocator.limit for slot in free)
+
+
+@pytest.mark.parametrize('policy', POLICIES)
+@pytest.mark.parametrize('retrigger', [False, True])
+def test_lowered_limit_trims_on_next_note(policy, retrigger):
+    engine, patch = held_notes(policy, retrigger)
+    allocator = engine.allocator
+    assert engine.bank.n_active == 4
+
+    allocator.limit = 2
+    engine.note_on(20, patch)
+    assert engine.bank.n_active == 2
+    check_books(allocator)
+
+    for note in (21, 22, 20):
+        engine.note_on(note, patch)
+        engine.render(256)
+        assert engine.bank.n_active <= 2
+        check_books(allocator)
+
+
+@pytest.mark.parametrize('policy', POLICIES)
+def test_retriggered_note_trims(policy):
+    engine, patch = held_notes(policy, retrigger=True)
+    allocator = engine.allocator
+
+    allocator.limit = 2
+    engine.note_on(10, patch)
+    assert engine.bank.n_active == 2
+    assert allocator._slot_of[10] < 2
+    check_books(allocator)
+
+    # a note held above the lowered limit does not keep its slot either
+    engine, patch = held_notes(policy, retrigger=True)
+    allocator = engine.allocator
+    allocator.limit = 3
+    engine.note_on(13, patch) # slot 3
+    assert engine.bank.n_active <= 3
+    assert allocator._slot_of[13] < 3
+    check_books(allocator)
+
+
+def test_raised_limit_restores_polyphony():
+    engine, patch = held_notes('oldest', retrigger=True)
+    allocator = engine.allocator
+    allocator.limit = 2
+    engine.note_on(20, patch)
+
+    allocator.limit = 6
+    for note in range(30, 36):
+        engine.note_on(note, patch)
+    assert engine.bank.n_active == 6
+    check_books(allocator)
@@ -0,0 +1,55 @@
+"""Block filter kernels against the per-sample reference loop.
+
+Run from the crudesynth directory with `python -m pytest -q`.
+"""
+import numpy as np
+import pytest
+
+from dsp import RBJFilter
+
+SAMPLE_RATE = 44100
+TOL = 1e-10
+
+
+def pair(cutoff):
+    """Two filters in the same state, one for each implementation"""
+    return RBJFilter(cutoff, SAMPLE_RATE), RBJFilter(cutoff, SAMPLE_RATE)
+
+
+@pytest.mark.parametrize('frames', [7, 33, 1000, 1024])
+@pytest.mark.parametrize('cutoff', [50, 750, 5000, 18000])
+def test_process_matches_direct(frames, cutoff):
+    rng = np.random.default_rng(frames)
+    block, direct = pair(cutoff)
+
+    # several blocks so the state carries over, with a cutoff change between
+    for i, f in enumerate([frames, frames, frames + 5]):
+        if i == 2:
+            block.set_cutoff(cutoff * 0.5)
+            direct.set_cutoff(cutoff * 0.5)
+        x = rng.uniform(-1, 1, f)
+        y = block.process(x.copy())
+        ref = direct.process_direct(x.copy())
+
+        np.testing.assert_allclose(y, ref, rtol=0, atol=TOL)
+        np.testing.assert_allclose(block.w, direct.w, rtol=0, atol=TOL)
+
+
+@pytest.mark.parametrize('frames', [7, 33, 1000, 1024])
+def test_process_cutoff_matches_per_sample_direct(frames):
+    rng = np.random.default_rng(frames)
+    block, direct = pair(750)
+
+    for _ in range(3):
+        x = rng.uniform(-1, 1, frames)
+        cutoff = 400 + 300 * np.sin(np.linspace(0, 2*np.pi, frames) + rng.uniform(0, 6))
+        y = block.process_cutoff(x.copy(), cutoff)
+
+        # new coefficients for every sample
+        ref = x.copy()
+        for i in range(frames):
+            direct.set_cutoff(cutoff[i])
+            direct.process_direct(ref[i:i+1])
+
+        np.testing.assert_allclose(y, ref, rtol=0, atol=TOL)
+        np.testing.assert_allclose(block.w, direct.w, rtol=0, atol=TOL)
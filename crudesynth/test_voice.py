@@ -0,0 +1,52 @@
+"""Reference per-note Voice (bench.py) against the VoiceBank the app renders.
+
+Run from the crudesynth directory with `python -m pytest -q`.
+"""
+import copy
+
+import numpy as np
+import pytest
+
+from bench import build_voice
+from core import VoiceBank, freqs, gen_funcs
+from offline import DEFAULT_PATCH
+
+FRAMES = 256
+TOL = 1e-12
+SEED = 3
+
+LFO = {'wave': 'triangle', 'rate': 5, 'depth': 20, 'duty': 0.5, 'pwm': 0.2}
+
+
+def make_patch(wave, lfo):
+    patch = copy.deepcopy(DEFAULT_PATCH)
+    patch['osc'] = [
+        dict(patch['osc'][0], wave=wave, duty=0.3, lfo=lfo),
+        # second layer detuned, never noise so both sides draw noise alike
+        dict(patch['osc'][0], wave='sine', detune=7, gain=0.3, lfo=lfo),
+    ]
+    patch['adsr'] = {'Attack': 0.02, 'Decay': 0.05, 'Sustain': 0.6, 'Release': 0.1}
+    return patch
+
+
+@pytest.mark.parametrize('lfo', [None, LFO], ids=['plain', 'lfo'])
+@pytest.mark.parametrize('wave', list(gen_funcs))
+def test_voice_matches_bank(wave, lfo):
+    patch = make_patch(wave, lfo)
+    bank = VoiceBank(2, freqs, gen_funcs, FRAMES, seed=SEED)
+    bank.note_on(0, 45, patch)
+    # the bank's first voice draws its noise from the first spawned seed
+    voice = build_voice(45, patch, freqs, gen_funcs, seed=np.random.SeedSequence(SEED).spawn(1)[0])
+
+    # attack, decay and sustain, then release mid level until the voice ends
+    for i in range(40):
+        if i == 5:
+            bank.release(0, patch['adsr']['Release'])
+            voice.release(patch['adsr'])
+
+        ref = voice.get_audio_data(FRAMES)
+        out = bank.mix(bank.render(FRAMES))
+        np.testing.assert_allclose(out, ref, rtol=0, atol=TOL)
+        assert (bank.n_active == 0) == voice.finished
+
+    assert voice.finished and not bank.n_active
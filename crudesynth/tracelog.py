@@ -0,0 +1,190 @@
+"""Per-block engine trace for looking into underflows after the fact.
+
+With TRACE_PATH set in settings.py the engine records one fixed size
+binary record per rendered block into a preallocated ring; a background
+thread appends new records to the file twice a second. The render path
+only fills a row of a numpy array, so tracing costs a few microseconds per
+block and never touches the disk. If the writer falls more than a ring
+behind (less one slot of margin), the oldest records are dropped and
+counted.
+
+Summarize a trace with
+
+    python tracelog.py trace.bin [--worst 10]
+"""
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from dsp import IDLE
+
+MAGIC = b'CSTRACE1\n'
+
+TRACE_DTYPE = np.dtype([
+    ('time', 'f8'), # perf_counter at the end of the block
+    ('voices', 'u2'), # active voices
+    ('osc1', '?'), # any voice with the layer on
+    ('osc2', '?'),
+    ('lfos', 'u2'), # active oscillator LFOs
+    ('filter', '?'),
+    ('filter_lfo', '?'),
+    ('oversample', 'u1'),
+    ('commands_ms', 'f4'), # stage times, see AudioEngine.render
+    ('lfo_ms', 'f4'),
+    ('voices_ms', 'f4'),
+    ('mix_ms', 'f4'),
+    ('filter_ms', 'f4'),
+    ('output_ms', 'f4'),
+    ('total_ms', 'f4'),
+    ('load', 'f4'), # total / block deadline
+    ('underflow', '?'), # an underflow was reported since the previous block
+])
+
+STAGES = ('commands_ms', 'lfo_ms', 'voices_ms', 'mix_ms', 'filter_ms', 'output_ms')
+
+class Tracer:
+    def __init__(self, path, capacity=4096, interval=0.5):
+        self.path = path
+        self.capacity = capacity
+        self.interval = interval
+        self.dropped = 0
+
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+
+        self._ring = np.zeros(capacity, dtype=TRACE_DTYPE)
+        self._written = 0 # records produced
+        self._flushed = 0 # records on disk (or dropped)
+        self._underflows = 0
+        self._running = False
+        self._thread = None
+
+    # ------- Render side
+    def record(self, engine, times, budget):
+        """Add a record for the block just rendered.
+
+        times are the stage seconds in STAGES order, then the total.
+        Only fills a row of the ring; the file is written by the thread
+        from start().
+        """
+        bank = engine.bank
+        active = bank.stage != IDLE
+        rec = self._ring[self._written % self.capacity]
+        rec['time'] = time.perf_counter()
+        rec['voices'] = np.count_nonzero(active)
+        rec['osc1'] = bank.osc_on[active, 0].any()
+        rec['osc2'] = bank.osc_on[active, 1].any()
+        rec['lfos'] = np.count_nonzero(bank.lfo_on[active])
+        rec['filter'] = engine.filter_on
+        rec['filter_lfo'] = engine.filter_lfo.on
+        rec['oversample'] = engine.oversample
+        for name, t in zip(STAGES + ('total_ms',), times):
+            rec[name] = t * 1e3
+        rec['load'] = times[-1] / budget
+        rec['underflow'] = engine.underflows != self._underflows
+        self._underflows = engine.underflows
+
+        self._written += 1
+        return
+
+    # ------- Writer
+    def start(self):
+        """Start the writer thread, in the process that renders (threads
+        do not survive the fork of EngineProcess)"""
+        self._running = True
+        self._thread = threading.Thread(target=self._flush_loop, name='trace', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._running = False
+        self._thread.join()
+        self.flush()
+
+    def _flush_loop(self):
+        while self._running:
+            time.sleep(self.interval)
+            self.flush()
+        return
+
+    def flush(self):
+        written = self._written
+        start = self._flushed
+        if written - start >= self.capacity:
+            # overwritten before they could be saved; the oldest slot is
+            # also the one the renderer fills next, so skip it as well
+            self.dropped += written - start - self.capacity + 1
+            start = written - self.capacity + 1
+        if start == written:
+            return
+
+        idx = np.arange(start, written) % self.capacity
+        with open(self.path, 'ab') as f:
+            self._ring[idx].tofile(f)
+        self._flushed = written
+        return
+
+
+# -----------------------------
+def read_trace(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a crude synth trace')
+        return np.fromfile(f, dtype=TRACE_DTYPE)
+
+def summarize(records, worst=10, context=4):
+    """Text report: totals, the `worst` slowest blocks and, for each
+    underflow, the slowest of the `context` blocks before it"""
+    lines = []
+    if not len(records):
+        return 'empty trace'
+
+    seconds = records['time'][-1] - records['time'][0]
+    load = records['load']
+    lines.append(
+        f'{len(records)} blocks over {seconds:.1f} s, '
+        f'{np.count_nonzero(records["underflow"])} with underflows'
+    )
+    lines.append(
+        f'load mean {load.mean():.1%}  p99 {np.percentile(load, 99):.1%}  max {load.max():.1%}'
+    )
+    lines.append('mean ms  ' + '  '.join(f'{s[:-3]} {records[s].mean():.3f}' for s in STAGES))
+
+    header = f'{"t (s)":>8} {"total ms":>9} {"load":>6} {"voices":>6} osc1 osc2 lfos filt flfo  os  uflow'
+    t0 = records['time'][0]
+    def row(r):
+        return (
+            f'{r["time"]-t0:8.2f} {r["total_ms"]:9.3f} {r["load"]:6.1%} {r["voices"]:6d} '
+            f'{r["osc1"]:4d} {r["osc2"]:4d} {r["lfos"]:4d} {r["filter"]:4d} {r["filter_lfo"]:4d} '
+            f'{r["oversample"]:3d}  {"yes" if r["underflow"] else ""}'
+        )
+
+    lines.append(f'\nworst {worst} blocks:')
+    lines.append(header)
+    for i in np.argsort(records['total_ms'])[::-1][:worst]:
+        lines.append(row(records[i]))
+
+    # the slowest of the few blocks rendered before each reported underflow
+    underflows = np.flatnonzero(records['underflow'])[:worst]
+    if len(underflows):
+        lines.append(f'\nslowest block before each underflow (first {len(underflows)}):')
+        lines.append(header)
+        for i in underflows:
+            before = records[max(i - context, 0):i + 1]
+            lines.append(row(before[np.argmax(before['total_ms'])]))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize an engine trace')
+    parser.add_argument('path', help='trace file written with TRACE_PATH set')
+    parser.add_argument('--worst', type=int, default=10, help='number of slowest blocks to list')
+    args = parser.parse_args()
+    print(summarize(read_trace(args.path), args.worst))
+
+
+if __name__ == '__main__':
+    main()
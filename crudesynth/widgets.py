@@ -1,7 +1,26 @@
+import functools
 import math
 
 import pygame
 
+# -----------------------------
+# Screen regions drawn since the last display update. Widgets add the
+# rect they redraw; the main loop pushes only these (or nothing at all).
+dirty_rects = []
+
+def mark_dirty(rect):
+    if rect not in dirty_rects:
+        dirty_rects.append(pygame.Rect(rect))
+
+def update_dirty():
+    """Update the dirty regions of the display; False on an idle frame"""
+    if not dirty_rects:
+        return False
+    pygame.display.update(dirty_rects)
+    dirty_rects.clear()
+    return True
+
+
 # -----------------------------
 class ValueBox:
     def __init__(self, value, x, y, font, width=9, format="{:.2f} Hz"):
@@ -31,6 +50,59 @@ class ValueBox:
         surface = pygame.display.get_surface()
         surface.fill('Black', self.rect)
         surface.blit(self.text_surf, self.text_rect)
+        mark_dirty(self.rect.union(self.text_rect))
+
+
+# -----------------------------
+class LoadMeter:
+    """DSP load bar (rolling load, peak tick) with the profiler figures
+    printed under it, see perf.py"""
+    def __init__(self, x, y, font, width=190, background=(90,91,107)):
+        self.font = font
+        self.background = background
+        self.bar = pygame.Rect(x, y, width, 10)
+        self.rect = pygame.Rect(x, y, width, 14 + 6*(font.height+2))
+        self.stats = None
+        self.gui_ms = 0.0
+        self.fps = None
+
+    def update(self, stats, gui_ms, fps=None):
+        self.stats = stats
+        self.gui_ms = gui_ms
+        self.fps = fps
+        self.draw()
+
+    def draw(self):
+        surface = pygame.display.get_surface()
+        surface.fill(self.background, self.rect)
+        pygame.draw.rect(surface, 'black', self.bar, 1)
+        mark_dirty(self.rect)
+        if self.stats is None:
+            return
+
+        stats = self.stats
+        load = min(stats['load'], 1.0)
+        color = 'green' if load < 0.5 else 'yellow' if load < 0.8 else 'red'
+        inner = self.bar.inflate(-2, -2)
+        surface.fill(color, (inner.x, inner.y, int(inner.width * load), inner.height))
+
+        peak_x = inner.x + int(inner.width * min(stats['peak_load'], 1.0)) - 1
+        pygame.draw.line(surface, 'white', (peak_x, inner.top), (peak_x, inner.bottom-1))
+
+        stages = [f'{name} {ms:.2f}' for name, ms in stats['stages'].items()]
+        lines = [
+            f"DSP {stats['load']:.0%}  peak {stats['peak_load']:.0%}",
+            f"worst {stats['worst_ms']:.1f} ms  underflows {stats['underflows']}",
+        ] + [
+            '  '.join(stages[i:i+2]) + ' ms' for i in range(0, len(stages), 2)
+        ] + [
+            f"GUI draw {self.gui_ms:.2f} ms" + (f"  {self.fps} fps" if self.fps else ''),
+        ]
+        y = self.bar.bottom + 4
+        for line in lines:
+            text = self.font.render(line, True, 'white')
+            surface.blit(text, (self.bar.x, y))
+            y += self.font.height + 2
 
 
 # ----------------------------
@@ -41,15 +113,19 @@ class Publisher:
         self.active = False
         self.updatable = True
 
-    def add_subscriber(self, obj=None, attr=None, method=None, is_dict=False, value=True):
+    def add_subscriber(self, obj=None, attr=None, method=None, is_dict=False, value=True, automated=True):
+        """automated=False: not told about values set by automation, e.g.
+        the engine, which produced them"""
         self._subscribers.append(
-            dict(obj=obj, attr=attr, method=method, is_dict=is_dict, value=value)
+            dict(obj=obj, attr=attr, method=method, is_dict=is_dict, value=value, automated=automated)
         )
         return
 
-    def notify_subscribers(self):
+    def notify_subscribers(self, automated=False):
         """A bit nicer, can just pass method/function"""
         for subscriber in self._subscribers:
+            if automated and not subscriber['automated']:
+                continue
 
             if subscriber["is_dict"]:
                 #subscriber['obj'][subscriber['attr']] = self.value
@@ -100,6 +176,7 @@ class Button(Publisher):
             pygame.draw.rect(surface, 'gray49', self.rect)
         else:
             pygame.draw.rect(surface, 'gray19', self.rect)
+        mark_dirty(self.rect)
 
 class Toggle(Publisher):
     def __init__(self, x, y, width, height):
@@ -131,6 +208,7 @@ class Toggle(Publisher):
             pygame.draw.rect(surface, 'red', self.rect)
         else:
             pygame.draw.rect(surface, 'gray19', self.rect)
+        mark_dirty(self.rect)
 
 
 # ---------------------------
@@ -205,6 +283,7 @@ class DropDownMenu(Publisher):
     def clear_draw(self):
         surface = pygame.display.get_surface()
         surface.blit(self.under_surf, self.down_rect, self.down_rect) 
+        mark_dirty(self.down_rect)
 
 
     def draw(self):
@@ -212,6 +291,7 @@ class DropDownMenu(Publisher):
 
         pygame.draw.rect(surface, (75,75,75), self.rect) # -- Selected item background
         surface.blit(self.menu[self.menu_text][0], self.rect) # -- The selected menu item text
+        mark_dirty(self.rect)
 
         if self.active:
             # If drop down button was clicked, show menu items
@@ -221,12 +301,49 @@ class DropDownMenu(Publisher):
             if self.hilite:
                 pygame.draw.rect(surface, 'grey', self.hilite[1])
                 surface.blit(self.hilite[0], self.hilite[1])
+            mark_dirty(self.down_rect)
 
         return
 
 # ------------------------------------
+class KnobAtlas:
+    """Knob faces pre-rendered for every whole degree of travel, laid out
+    in a grid on one surface; drawing a knob is then a single blit"""
+    COLUMNS = 16
+
+    def __init__(self, radius, min_angle, max_angle):
+        self.size = radius*2
+        self.min_angle = min_angle
+        self.max_angle = max_angle
+
+        n = max_angle - min_angle + 1
+        rows = -(-n // self.COLUMNS)
+        self.surface = pygame.Surface((self.size*self.COLUMNS, self.size*rows)).convert()
+        self.surface.fill('gray49')
+
+        for i in range(n):
+            x, y = self._cell(i)
+            rad = math.radians(min_angle + i)
+            center = (x + radius, y + radius)
+            end = (center[0] + radius * math.cos(rad), center[1] + radius * math.sin(rad))
+            pygame.draw.circle(self.surface, 'Black', center, radius)
+            pygame.draw.line(self.surface, 'White', center, end, 3)
+
+    def _cell(self, i):
+        return (i % self.COLUMNS) * self.size, (i // self.COLUMNS) * self.size
+
+    def blit(self, surface, rect, degree):
+        i = min(max(round(degree), self.min_angle), self.max_angle) - self.min_angle
+        x, y = self._cell(i)
+        surface.blit(self.surface, rect, (x, y, self.size, self.size))
+
+@functools.lru_cache(maxsize=None)
+def knob_atlas(radius, min_angle, max_angle):
+    """One atlas per knob size, built on first draw (needs the display)"""
+    return KnobAtlas(radius, min_angle, max_angle)
+
 class Knob(Publisher):
-    def __init__(self, x, y, radius=25, min_val=0.01, max_val=1.0, int_value=False, is_neg=False):
+    def __init__(self, x, y, radius=25, min_val=0.01, max_val=1.0, int_value=False, is_neg=False, value=None):
         super().__init__()
         #self.name = name #not used currently
         self.is_neg = is_neg
@@ -248,8 +365,15 @@ class Knob(Publisher):
 
         self.max_val = max_val
         self.min_val = min_val
-        self.degree_to_value()
-        self._make_line()
+        if value is None: # start centered
+            self.degree_to_value()
+        else:
+            self.value = value
+            self._clamp_value()
+            self.value_to_degree()
+
+        self._automated = False # value moved by automation, not drawn yet
+        self._next_refresh = 0.0
 
     def degree_to_value(self):
         self.value = self.max_val * round((self.degree-self.min_angle) / self.angle_range, 4)
@@ -279,13 +403,24 @@ class Knob(Publisher):
         return
 
     def automated_update(self, mod_value):
+        """Follow a value set elsewhere (e.g. the filter LFO). Only the
+        value moves here; refresh_automation draws it"""
         self.value = mod_value
         self._clamp_value()
         self.value_to_degree()
         self._clamp_angle()
-        self._make_line()
+        self._automated = True
+        return
+
+    def refresh_automation(self, now, interval):
+        """Draw the latest automated value and update the subscribers that
+        take automation, at most once per interval (s)"""
+        if not self._automated or now < self._next_refresh:
+            return
+        self._automated = False
+        self._next_refresh = now + interval
         self.draw()
-        self.notify_subscribers()
+        self.notify_subscribers(automated=True)
         return
 
     def update(self):
@@ -297,17 +432,10 @@ class Knob(Publisher):
         self.degree_to_value()
         self._clamp_value()
 
-        self._make_line()
         self.draw()
         self.notify_subscribers()
         return
 
-    def _make_line(self, delta_y=0):
-        rad = math.radians(self.degree)
-        self.line_x = self.circle_rect.centerx + self.radius * math.cos(rad)
-        self.line_y = self.circle_rect.centery + self.radius * math.sin(rad)
-        self.degree = math.degrees(rad)
-
     def handle_input(self, event):
         if event.type == pygame.MOUSEBUTTONDOWN and self.active == False:
             self.start_y = event.pos[1]
@@ -321,9 +449,9 @@ class Knob(Publisher):
 
     def draw(self):
         surface = pygame.display.get_surface()
-        pygame.draw.rect(surface, 'gray49', self.rect)
-        pygame.draw.circle(surface, 'Black', self.circle_rect.center, self.radius)
-        pygame.draw.line(surface, 'White', self.circle_rect.center, (self.line_x, self.line_y), 3)
+        atlas = knob_atlas(self.radius, self.min_angle, self.max_angle)
+        atlas.blit(surface, self.rect, self.degree)
+        mark_dirty(self.rect)
 
         return
 